@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# Offline benchmark for gitlab_reports. A synthetic gitlab instance is served
+# from a local HTTP server (the part of the v4 API the crawl uses), and a
+# crawl, the database load, an incremental sync and every report are timed
+# against it. Results are written as JSON, together with the breakdown
+# gitlab_reports records for each run, so runs can be compared:
+#
+#   python3 benchmark.py --projects 200 --commits 500 --output before.json
+#   python3 benchmark.py --projects 200 --commits 500 --compare before.json
+#
+# The server runs in its own process so it does not compete with the code
+# being measured. Peak memory per phase comes from tracemalloc, which slows
+# the run down; use --no-tracemalloc for timings only.
+import argparse
+import datetime
+import http.server
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import repo_data
+import gitlab_reports as reports_module
+
+TOKEN = "benchmark-token-0000"
+EPOCH = datetime.datetime(2016,1,1,tzinfo=datetime.timezone.utc)
+SPAN = 3 * 365 * 86400
+
+def iso(seconds):
+    return (EPOCH + datetime.timedelta(seconds=seconds)).strftime("%Y-%m-%dT%H:%M:%S.000+00:00")
+
+# The aliases a user's commits may show up under: a .mil address, a laptop
+# address, a capitalised name and an anonymous placeholder (which makes the
+# reports fall back to the next identifying field).
+def alias_variants(name):
+    return [name + ".mil", name + "@laptop.local", name.capitalize(), "root"]
+
+# A deterministic synthetic instance. Projects live in the namespaces from
+# repo_data.py or in personal namespaces; forks copy their source's commits
+# and add a few of their own, mirrors copy part of another project without
+# being marked as forks, and alias_noise is the share of commits made under
+# one of a user's aliases.
+class synthetic_instance:
+
+    def __init__(self,projects=50,commits=200,users=None,forks=0.1,mirrors=0.05,alias_noise=0.2,seed=1):
+        self.random = random.Random(seed)
+        self.users = ["user{:04d}".format(i) for i in range(users or max(5,projects // 2))]
+        namespaces = list(repo_data.namespace_to_course.keys()) + list(repo_data.known_namespaces)
+        self.alias_noise = alias_noise
+        self.projects = []
+        self.commits = {}
+        self.next_id = 1
+        originals = []
+        for i in range(projects):
+            if self.random.random() < 0.3:
+                namespace = self.random.choice(self.users)
+            else:
+                namespace = self.random.choice(namespaces)
+            project = self.add_project("{}/project{}".format(namespace,i),[self.make_commit(self.random.randrange(SPAN)) for j in range(commits)])
+            originals.append(project)
+        for project in originals:
+            if self.random.random() < forks:
+                extra = [self.make_commit(self.random.randrange(SPAN)) for j in range(max(1,commits // 20))]
+                fork = self.add_project("{}/fork-of-{}".format(self.random.choice(self.users),project["id"]),self.commits[project["id"]] + extra)
+                fork["forked_from_project"] = { "id" : project["id"], "path_with_namespace" : project["path_with_namespace"] }
+            elif self.random.random() < mirrors:
+                source = self.commits[self.random.choice(originals)["id"]]
+                self.add_project("mirror/mirror-{}".format(project["id"]),source[:max(1,len(source) // 2)])
+
+    def make_commit(self,seconds):
+        user = self.random.choice(self.users)
+        author = committer = user
+        email = user + "@example.mil"
+        if self.random.random() < self.alias_noise:
+            committer = self.random.choice(alias_variants(user))
+            email = committer if "@" in committer else email
+        date = iso(seconds)
+        sha = "{:040x}".format(self.random.getrandbits(160))
+        return {
+            "id" : sha,
+            "short_id" : sha[:8],
+            "created_at" : date,
+            "parent_ids" : [],
+            "title" : "Commit {}".format(sha[:8]),
+            "message" : "Commit {}\n\nSynthetic benchmark commit.".format(sha[:8]),
+            "author_name" : author,
+            "author_email" : user + "@example.mil",
+            "authored_date" : date,
+            "committer_name" : committer,
+            "committer_email" : email,
+            "committed_date" : date,
+            "_time" : seconds
+        }
+
+    def add_project(self,path,commits):
+        commits = sorted(commits,key=lambda c: c["_time"],reverse=True)
+        project = {
+            "id" : self.next_id,
+            "path_with_namespace" : path,
+            "name" : path.split("/")[-1],
+            "last_activity_at" : commits[0]["committed_date"] if commits else iso(0)
+        }
+        self.next_id += 1
+        self.projects.append(project)
+        self.commits[project["id"]] = commits
+        return project
+
+    # New commits on a share of the projects, as seen by an incremental sync.
+    def advance(self,share=0.1,commits=5):
+        changed = 0
+        for project in self.projects:
+            if self.random.random() < share:
+                latest = self.commits[project["id"]][0]["_time"] if self.commits[project["id"]] else 0
+                new = [self.make_commit(latest + 60 * (j + 1)) for j in range(commits)]
+                self.commits[project["id"]] = sorted(new,key=lambda c: c["_time"],reverse=True) + self.commits[project["id"]]
+                project["last_activity_at"] = self.commits[project["id"]][0]["committed_date"]
+                changed += 1
+        return changed
+
+    def summary(self):
+        return {
+            "projects" : len(self.projects),
+            "forks" : sum(1 for p in self.projects if "forked_from_project" in p),
+            "mirrors" : sum(1 for p in self.projects if p["path_with_namespace"].startswith("mirror/")),
+            "commits" : sum(len(c) for c in self.commits.values()),
+            "users" : len(self.users)
+        }
+
+# Serves projects (keyset and offset pagination) and repository commits
+# (offset pagination, with since) like the gitlab v4 API, plus two control
+# endpoints under /_benchmark/ for the benchmark itself.
+class fake_gitlab_handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self,format,*args):
+        pass
+
+    def send_json(self,value,next_query=None,status=200):
+        body = json.dumps(value).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type","application/json")
+        self.send_header("Content-Length",str(len(body)))
+        if next_query is not None:
+            url = "http://{}:{}{}?{}".format(self.server.server_address[0],self.server.server_address[1],urllib.parse.urlparse(self.path).path,urllib.parse.urlencode(next_query))
+            self.send_header("Link",'<{}>; rel="next"'.format(url))
+            if "page" in next_query:
+                self.send_header("X-Next-Page",str(next_query["page"]))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        parts = url.path.strip("/").split("/")
+        instance = self.server.instance
+        if parts == ["_benchmark","stats"]:
+            return self.send_json({ "requests" : self.server.requests })
+        self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.headers.get("PRIVATE-TOKEN") != TOKEN:
+            return self.send_json({ "message" : "401 Unauthorized" },status=401)
+        per_page = int(query.get("per_page",20))
+        if parts == ["api","v4","projects"]:
+            projects = sorted(instance.projects,key=lambda p: p["id"],reverse=True)
+            if query.get("pagination") == "keyset":
+                if "id_before" in query:
+                    projects = [p for p in projects if p["id"] < int(query["id_before"])]
+                page = projects[:per_page]
+                more = dict(query,id_before=page[-1]["id"]) if len(projects) > per_page else None
+                return self.send_json([self.public(p) for p in page],more)
+            return self.send_paged([self.public(p) for p in projects],query,per_page)
+        if len(parts) == 6 and parts[:3] == ["api","v4","projects"] and parts[4:] == ["repository","commits"]:
+            commits = instance.commits.get(int(parts[3]))
+            if commits is None:
+                return self.send_json({ "message" : "404 Project Not Found" },status=404)
+            if "since" in query:
+                since = reports_module.to_epoch(query["since"])
+                commits = [c for c in commits if reports_module.to_epoch(c["committed_date"]) >= since]
+            return self.send_paged([self.public(c) for c in commits],query,per_page)
+        self.send_json({ "message" : "404 Not Found" },status=404)
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == "/_benchmark/advance":
+            return self.send_json({ "changed" : self.server.instance.advance(float(query.get("share",0.1))) })
+        self.send_json({ "message" : "404 Not Found" },status=404)
+
+    def send_paged(self,items,query,per_page):
+        page = int(query.get("page",1))
+        start = (page - 1) * per_page
+        more = dict(query,page=page + 1) if start + per_page < len(items) else None
+        self.send_json(items[start:start + per_page],more)
+
+    def public(self,item):
+        return dict((k,v) for k,v in item.items() if not k.startswith("_"))
+
+def serve(options,ready):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1",0),fake_gitlab_handler)
+    server.daemon_threads = True
+    server.instance = synthetic_instance(options["projects"],options["commits"],options["users"],options["forks"],options["mirrors"],options["alias_noise"],options["seed"])
+    server.requests = 0
+    server.latency = options["latency"] / 1000.0
+    ready.send((server.server_address[1],server.instance.summary(),server.instance.users))
+    server.serve_forever()
+
+def control(base_url,path,method="GET"):
+    request = urllib.request.Request(base_url + path,method=method,data=b"" if method == "POST" else None)
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+# Times a phase and, with tracemalloc running, records the peak of memory
+# allocated during it.
+class phase_timer:
+
+    def __init__(self,results,name,**extra):
+        self.results = results
+        self.name = name
+        self.extra = extra
+
+    def __enter__(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self,*exc):
+        entry = { "seconds" : time.perf_counter() - self.start }
+        if tracemalloc.is_tracing():
+            entry["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+        entry.update(self.extra)
+        self.results[self.name] = entry
+        return False
+
+# The crawl, save and load steps are timed separately by wrapping the methods
+# refresh_data calls.
+class benchmark_reports(reports_module.gitlab_reports):
+
+    def get_latest_data(self,*args,**kwargs):
+        with phase_timer(self.phases,self.phase_prefix + "crawl"):
+            super().get_latest_data(*args,**kwargs)
+
+    def save_latest_data(self):
+        with phase_timer(self.phases,self.phase_prefix + "save"):
+            super().save_latest_data()
+
+    def populate_db(self,*args,**kwargs):
+        with phase_timer(self.phases,self.phase_prefix + "load"):
+            super().populate_db(*args,**kwargs)
+
+def report_rows(reports,before):
+    return sum(len(table) - 1 for key, table in reports.csv.items() if before.get(key) is not table and isinstance(table,list))
+
+def run(args):
+    for user in args.user_list:
+        repo_data.known_aliases.setdefault(user,[]).extend(v.lower() for v in alias_variants(user) if v != "root")
+    repo_data.compile_lookups()
+
+    base_url = "http://127.0.0.1:{}/".format(args.port)
+    phases = {}
+    if args.tracemalloc:
+        tracemalloc.start()
+    benchmark_reports.phases = phases
+
+    benchmark_reports.phase_prefix = ""
+    r = benchmark_reports(base_url=base_url,api_code=TOKEN,fresh=True,workers=args.workers,rate_limit=args.rate_limit,quiet=True,engine=args.engine)
+    requests = control(base_url,"_benchmark/stats")["requests"]
+    commits = sum(entry["commits"] for entry in r.manifest.values())
+    phases["crawl"].update(commits=commits,requests=requests,commits_per_second=commits / phases["crawl"]["seconds"],requests_per_second=requests / phases["crawl"]["seconds"])
+    phases["load"].update(rows=r.load_stats["rows"],rows_per_second=r.load_stats["rows_per_second"])
+    metrics = { "refresh" : r.last_metrics }
+
+    for name in r.REPORTS:
+        before = dict(r.csv)
+        with phase_timer(phases,"report:" + name):
+            getattr(r,name)(args.from_date,args.to_date)
+        phases["report:" + name]["rows"] = report_rows(r,before)
+    with phase_timer(phases,"write"):
+        r.write_charts()
+        r.write_csv()
+    with phase_timer(phases,"reports_cached"):
+        r.build_all_reports(args.from_date,args.to_date)
+    metrics["reports_cached"] = r.last_metrics
+
+    benchmark_reports.phase_prefix = "startup:"
+    with phase_timer(phases,"startup"):
+        benchmark_reports(base_url=base_url,api_code=TOKEN,workers=args.workers,rate_limit=args.rate_limit,quiet=True,engine=args.engine)
+
+    changed = control(base_url,"_benchmark/advance?share={}".format(args.changed),"POST")["changed"]
+    benchmark_reports.phase_prefix = "sync:"
+    before = control(base_url,"_benchmark/stats")["requests"]
+    with phase_timer(phases,"sync",changed_projects=changed):
+        r.refresh_data(incremental=True)
+    phases["sync"]["requests"] = control(base_url,"_benchmark/stats")["requests"] - before
+    metrics["sync"] = r.last_metrics
+
+    if args.tracemalloc:
+        tracemalloc.stop()
+    return phases, metrics
+
+def compare(results,previous):
+    print("{:<45}{:>12}{:>12}{:>9}".format("phase","previous","current","ratio"))
+    for name, entry in results["phases"].items():
+        old = previous["phases"].get(name)
+        if old is None:
+            print("{:<45}{:>12}{:>12.3f}".format(name,"-",entry["seconds"]))
+            continue
+        ratio = entry["seconds"] / old["seconds"] if old["seconds"] else float("inf")
+        print("{:<45}{:>12.3f}{:>12.3f}{:>8.2f}x".format(name,old["seconds"],entry["seconds"],ratio))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark gitlab_reports against a local synthetic gitlab instance.")
+    parser.add_argument("--projects",type=int,default=50,help="projects to generate, not counting forks and mirrors")
+    parser.add_argument("--commits",type=int,default=200,help="commits per project")
+    parser.add_argument("--users",type=int,default=None,help="distinct users (default: half the projects, at least 5)")
+    parser.add_argument("--forks",type=float,default=0.1,help="share of projects that get a fork")
+    parser.add_argument("--mirrors",type=float,default=0.05,help="share of projects that get an unmarked mirror of another project")
+    parser.add_argument("--alias-noise",type=float,default=0.2,help="share of commits made under an alias")
+    parser.add_argument("--changed",type=float,default=0.1,help="share of projects with new commits for the incremental sync")
+    parser.add_argument("--seed",type=int,default=1)
+    parser.add_argument("--latency",type=float,default=0,help="milliseconds the server waits before each response")
+    parser.add_argument("--workers",type=int,default=reports_module.gitlab_reports.MAX_WORKERS)
+    parser.add_argument("--rate-limit",type=float,default=100000,help="client request budget per second")
+    parser.add_argument("--engine",default="python",choices=("python","numpy"))
+    parser.add_argument("--no-tracemalloc",dest="tracemalloc",action="store_false",help="skip per-phase memory tracing")
+    parser.add_argument("--output",help="write the results to this JSON file instead of stdout")
+    parser.add_argument("--compare",help="previous results file to compare phase timings with")
+    parser.add_argument("--keep",action="store_true",help="keep the working directory with the history and report files")
+    args = parser.parse_args(argv)
+    args.from_date = iso(0).replace("+00:00","Z")
+    args.to_date = iso(SPAN + 86400).replace("+00:00","Z")
+
+    options = dict((k,getattr(args,k)) for k in ("projects","commits","users","forks","mirrors","alias_noise","seed","latency"))
+    receive, send = multiprocessing.Pipe(False)
+    server = multiprocessing.Process(target=serve,args=(options,send),daemon=True)
+    server.start()
+    args.port, instance, args.user_list = receive.recv()
+
+    workdir = tempfile.mkdtemp(prefix="gitlab-reports-benchmark-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    started = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    try:
+        phases, metrics = run(args)
+    finally:
+        os.chdir(cwd)
+        server.terminate()
+        if args.keep:
+            print("Working directory kept at {}".format(workdir),file=sys.stderr)
+        else:
+            shutil.rmtree(workdir,ignore_errors=True)
+
+    results = {
+        "started" : started,
+        "config" : dict((k,v) for k,v in vars(args).items() if k not in ("output","compare","keep","user_list","port")),
+        "environment" : {
+            "python" : platform.python_version(),
+            "platform" : platform.platform(),
+            "cpus" : os.cpu_count()
+        },
+        "instance" : instance,
+        "phases" : phases,
+        "metrics" : metrics
+    }
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results["peak_rss_bytes"] = peak if sys.platform == "darwin" else peak * 1024
+    if args.output:
+        with open(args.output,"w") as f:
+            json.dump(results,f,indent=2)
+    else:
+        print(json.dumps(results,indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results,json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+import collections
+import contextlib
+import sqlite3
+import threading
+import time
+import tracemalloc
+
+# Phase timers and counters for one refresh or report run. Phase times are
+# summed over every call and every thread, so a phase that runs on a worker
+# pool (fetching commits, parallel reports) can add up to more than the wall
+# time of the run.
+#
+# profile=True runs cProfile on the thread that started the run (worker
+# threads are not profiled) and trace_memory=True runs tracemalloc; both are
+# reported with the run's timings.
+class run_metrics:
+
+    PROFILE_TOP = 25
+    MEMORY_TOP = 10
+
+    def __init__(self,profile=False,trace_memory=False):
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.lock = threading.Lock()
+        self.profiler = None
+        self.tracing = False
+        self.reset()
+
+    def reset(self):
+        self.phases = collections.OrderedDict()
+        self.counters = collections.Counter()
+        self.started = time.time()
+        self.started_clock = time.perf_counter()
+
+    def start(self):
+        self.reset()
+        if self.profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.tracing = True
+            tracemalloc.reset_peak()
+
+    def add_time(self,name,seconds,calls=1):
+        with self.lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                phase = self.phases[name] = { "calls" : 0, "seconds" : 0.0 }
+            phase["calls"] += calls
+            phase["seconds"] += seconds
+
+    @contextlib.contextmanager
+    def phase(self,name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name,time.perf_counter() - start)
+
+    def count(self,name,n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def profile_report(self):
+        self.profiler.disable()
+        import pstats
+        stats = pstats.Stats(self.profiler)
+        functions = []
+        for (filename, line, function), (calls, primitive, total, cumulative, callers) in stats.stats.items():
+            functions.append({
+                "function" : "{}:{}({})".format(filename,line,function),
+                "calls" : calls,
+                "seconds" : total,
+                "cumulative_seconds" : cumulative
+            })
+        functions.sort(key=lambda f: f["cumulative_seconds"],reverse=True)
+        self.profiler = None
+        return functions[:self.PROFILE_TOP]
+
+    def memory_report(self):
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics("lineno")[:self.MEMORY_TOP]
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+        return {
+            "current_bytes" : current,
+            "peak_bytes" : peak,
+            "top" : [{ "line" : str(stat.traceback[0]), "bytes" : stat.size, "blocks" : stat.count } for stat in top]
+        }
+
+    # Ends the run: stops the profiler and tracemalloc if this run started
+    # them and returns everything recorded as a JSON-serializable dict.
+    def report(self,run,**extra):
+        report = {
+            "run" : run,
+            "started" : self.started,
+            "seconds" : time.perf_counter() - self.started_clock,
+            "phases" : dict(self.phases),
+            "counters" : dict(self.counters)
+        }
+        report.update(extra)
+        if self.profiler is not None:
+            report["profile"] = self.profile_report()
+        if self.trace_memory and tracemalloc.is_tracing():
+            report["memory"] = self.memory_report()
+        return report
+
+# A cursor that adds the time spent executing statements and fetching their
+# rows to the "sql" phase of its connection's run_metrics. Rows read by
+# iterating the cursor are not timed; see row_timed_cursor.
+class timed_cursor(sqlite3.Cursor):
+
+    metrics = None
+
+    def execute(self,*args):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            self.metrics.add_time("sql",time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self.metrics.add_time("sql",time.perf_counter() - start,0)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self.metrics.add_time("sql",time.perf_counter() - start,0)
+
+# Also times every row read by iterating the cursor. That costs a lock and
+# two clock reads per row, several times the cost of the row itself, so it
+# is only used for profiled runs.
+class row_timed_cursor(timed_cursor):
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return super().__next__()
+        finally:
+            self.metrics.add_time("sql",time.perf_counter() - start,0)
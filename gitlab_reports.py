@@ -1,5 +1,4 @@
 #!/usr/bin/env python3
-import gitlab
 import time
 import json
 import sys
@@ -8,20 +7,162 @@ import sqlite3
 import datetime
 import hashlib
 import secrets
+import csv
+import gzip
+import threading
+import collections
+import functools
+import inspect
+import itertools
 from repo_data import *
+from gitlab_metrics import run_metrics, timed_cursor, row_timed_cursor
 
 BASE_GITLAB_URL = "https://git.cybbh.space/"
 
+# python-gitlab and requests are only needed to talk to gitlab, and numpy only
+# for the numpy engine, so they are imported on first use. Commands that work
+# from local data never load them.
+gitlab = None
+requests = None
+rate_limited_session = None
+numpy = None
+
+def import_network():
+    global gitlab, requests, rate_limited_session
+    import gitlab
+    import requests
+    from gitlab_session import rate_limited_session
+
+def import_numpy():
+    global numpy
+    try:
+        import numpy
+    except ImportError:
+        return False
+    return True
+
 FROM_DATE="2015-12-06T00:00:00.000Z"
 TO_DATE="2019-08-17T00:00:00.000Z"
 
+# Commit dates are stored as epoch seconds (UTC). Gitlab returns timestamps like
+# 2019-08-16T14:02:11.000+02:00 and report ranges are given like FROM_DATE;
+# timestamps without an offset are taken to be UTC, integers are already epochs.
+def to_epoch(value):
+    if isinstance(value,int):
+        return value
+    if isinstance(value,datetime.datetime):
+        dt = value
+    else:
+        dt = datetime.datetime.fromisoformat(value.strip().replace("Z","+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(dt.timestamp())
+
+# A report table that is written out as rows are appended instead of being
+# kept in memory. It starts with the header row and goes to a temporary file
+# that replaces the report's CSV file on close, so a failed report never
+# leaves a partial file behind.
+class csv_stream:
+
+    def __init__(self,path,header = None):
+        self.path = path
+        self.file = None
+        self.rows = 0
+        if header is None: # already written
+            return
+        if path.endswith(".gz"):
+            self.file = gzip.open(path + ".tmp","wt",newline="")
+        else:
+            self.file = open(path + ".tmp","w",newline="")
+        self.writer = csv.writer(self.file,lineterminator="\n")
+        self.writer.writerow(header)
+
+    def append(self,row):
+        self.writer.writerow(row)
+        self.rows += 1
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        os.replace(self.path + ".tmp",self.path)
+
+    def discard(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        os.remove(self.path + ".tmp")
+
+    # Identifies the written file, so a cached report can tell it is intact.
+    def stamp(self):
+        st = os.stat(self.path)
+        return [self.path,st.st_size,st.st_mtime_ns]
+
+    def read(self):
+        opener = gzip.open if self.path.endswith(".gz") else open
+        with opener(self.path,"rt",newline="") as f:
+            return [tuple(row) for row in csv.reader(f)]
+
+# Report methods decorated with cached_report are served from the report
+# cache when called again with the same arguments on the same data.
+def cached_report(method):
+    @functools.wraps(method)
+    def wrapper(self,*args,**kwargs):
+        return self.cached_call(method,args,kwargs)
+    return wrapper
+
 class gitlab_reports:
 
+    LOCAL_HISTORY_DIR = ".history"
     LOCAL_HISTORY_FILE = ".all_history"
-    LOCAL_HISTORY = False
+    LOCAL_SYNC_FILE = ".sync_state"
+    SCHEMA_VERSION = 4
+    LOAD_CHUNK_SIZE = 10000
+    INTERVAL_DAYS = { "day" : 1, "week" : 7 }
+    FETCH_RETRIES = 4
+    RETRY_BACKOFF = 1
+    CHECKPOINT_INTERVAL = 60
+    MAX_WORKERS = 8
+    RATE_LIMIT = 10
+    PAGE_SIZE = 100
+    REPORT_CACHE_SIZE = 64
+    REPORT_CACHE_FILE = None
+    METRICS_FILE = None
+    CSV_STREAM = False
+    CSV_COMPRESS = False
+    CHART_FORMATS = ("dense", "sparse", "split")
+    CHART_FORMAT = "dense"
+    CHART_DIR = "chartjsdata"
+    CHART_MAX_POINTS = 1000
+    SPARSE_CHARTS = ("all_commits",)
+    # Commit fields the reports need. Anything else gitlab returns (title,
+    # message, parent_ids, ...) is dropped unless listed in commit_fields.
+    COMMIT_FIELDS = ("id","author_name","author_email","committer_name","committer_email","committed_date")
+
+    REPORTS = ("query_all_range","query_by_project","query_by_user","query_by_project_by_user","query_by_user_by_project","query_by_user_by_project_over_time","query_all_commits","query_duplicates")
+
+    # Reports write into self.csv and self.chartjs. While a report runs on the
+    # report pool these resolve to dicts private to its thread, which
+    # build_all_reports merges back in report order.
+    @property
+    def csv(self):
+        d = getattr(self.local,"csv",None)
+        return self.report_csv if d is None else d
 
-    csv = {}
-    chartjs = {}
+    @csv.setter
+    def csv(self,value):
+        self.report_csv = value
+
+    @property
+    def chartjs(self):
+        d = getattr(self.local,"chartjs",None)
+        return self.report_chartjs if d is None else d
+
+    @chartjs.setter
+    def chartjs(self,value):
+        self.report_chartjs = value
 
     def err(self,s):
         print(s)
@@ -37,8 +178,14 @@ class gitlab_reports:
         if len(self.API_CODE) != 20:
             self.err("Bad API access code")
 
+    # All requests go through a rate_limited_session (gitlab_session.py); its
+    # counters are available from self.session.stats(). The session does all
+    # the 429/503 backoff, so every API call passes obey_rate_limit=False to
+    # keep python-gitlab from retrying the same responses again.
     def connect_by_token(self):
-        gl = gitlab.Gitlab(self.BASE_URL,private_token=self.API_CODE)
+        import_network()
+        self.session = rate_limited_session(requests_per_second=self.RATE_LIMIT,pool_size=self.MAX_WORKERS)
+        gl = gitlab.Gitlab(self.BASE_URL,private_token=self.API_CODE,session=self.session)
         if self.DEBUG and self.VERBOSE:
             gl.enable_debug()
         self.gl = gl
@@ -47,112 +194,614 @@ class gitlab_reports:
         if self.DEBUG:
             print(s)
 
-    def query_project(self,project,ignore_duplicates = False):
+    # Report output goes through here so it can be recorded for the cache.
+    def out(self,s=""):
+        log = getattr(self.local,"report_log",None)
+        if log is not None:
+            log.append(s)
+        self.metrics.count("report_lines")
+        self.emit(s)
 
-        try:
-            commits = project.commits.list(all=True)
-        except gitlab.exceptions.GitlabListError:
+    # Nothing is printed in quiet mode; on the report pool, lines are held
+    # back and printed in report order once every report is done.
+    def emit(self,s):
+        if self.QUIET:
+            return
+        output = getattr(self.local,"output",None)
+        if output is not None:
+            output.append(s)
+        else:
+            start = time.perf_counter()
+            print(s)
+            self.metrics.add_time("print",time.perf_counter() - start)
+
+    # Runs on the worker pool: only talks to gitlab, never touches shared state.
+    # Transient errors (connection failures, 429 and 5xx responses) are retried
+    # with exponential backoff, except the 429/503 responses the session has
+    # already retried itself. Any other error, such as a 403 or 404 for a
+    # project without a repository, fails the project at once. Authentication
+    # errors abort the crawl so it can be resumed later.
+    #
+    # Commits are read lazily a page at a time (the commits API only offers
+    # offset pagination) and trimmed to the fields in commit_fields as they
+    # arrive, so only the projected dicts are held in memory.
+    def fetch_commits(self,project,since = None):
+        options = { "iterator" : True, "per_page" : self.PAGE_SIZE, "obey_rate_limit" : False }
+        if since:
+            options["since"] = since
+        with self.metrics.phase("api.commits"):
+            for attempt in range(self.FETCH_RETRIES + 1):
+                try:
+                    commits = [dict((field,getattr(commit,field,None)) for field in self.commit_fields) for commit in project.commits.list(**options)]
+                    self.metrics.count("commits_fetched",len(commits))
+                    return commits
+                except gitlab.exceptions.GitlabAuthenticationError:
+                    raise
+                except (gitlab.exceptions.GitlabError, requests.exceptions.RequestException) as e:
+                    if attempt == self.FETCH_RETRIES or not self.is_transient(e):
+                        self.debug("Giving up on {}: {}".format(project.path_with_namespace,e))
+                        return None
+                    delay = self.RETRY_BACKOFF * 2 ** attempt
+                    self.debug("Retrying {} in {}s: {}".format(project.path_with_namespace,delay,e))
+                    self.metrics.count("fetch_retries")
+                    time.sleep(delay)
+
+    def is_transient(self,e):
+        if isinstance(e,(requests.exceptions.ConnectionError,requests.exceptions.Timeout,requests.exceptions.ChunkedEncodingError)):
+            return True
+        code = getattr(e,"response_code",None)
+        if getattr(self,"session",None) is not None and code in self.session.RETRY_STATUS:
+            return False
+        return code is not None and (code == 429 or code >= 500)
+
+    # Only commits not already stored for the project are kept in
+    # commit_projects until complete_project appends them to the shard.
+    def query_project(self,project,ignore_duplicates = False,commits = None,since = None):
+
+        if commits is None:
+            commits = self.fetch_commits(project,since)
+        if commits is None:
             self.debug("Error querying commits for {}".format(project.path_with_namespace))
             self.failures.append(project.path_with_namespace)
             return
-        self.commit_projects[project.path_with_namespace] = []
-        for commit in commits:
-            current_commit = {
-                "id" : commit.id,
-                "created_at" : commit.created_at,
-                "parent_ids" : commit.parent_ids,
-                "title" : commit.title,
-                "message" : commit.message,
-                "author_name" : commit.author_name,
-                "author_email" : commit.author_email,
-                "authored_date" : commit.authored_date,
-                "committer_name" : commit.committer_name,
-                "committer_email" : commit.committer_email,
-                "committed_date" : commit.committed_date,
-                "duplicate" : False
-            }
-            if commit.id in self.commit_ids:
+        path = project.path_with_namespace
+        previous = self.manifest.get(path)
+        known = set(c["id"] for c in self.read_history(path)) if previous else set()
+        new_commits = []
+        for current_commit in commits:
+            if current_commit["id"] in known:
+                continue
+            current_commit["duplicate"] = False
+            key = self.commit_key(current_commit["id"])
+            # A push during the crawl can shift the pages and list a commit twice.
+            if self.commit_index.get(key) == path:
+                continue
+            if key in self.commit_index:
                 if ignore_duplicates:
-                    return
+                    break
                 else:
                     self.duplicates += 1
                     current_commit["duplicate"] = True
-            self.commit_ids.append(commit.id)
-            self.commit_projects[project.path_with_namespace].append(current_commit)
+                    current_commit["duplicate_of"] = self.commit_index[key]
+            else:
+                self.commit_index[key] = path
+            new_commits.append(current_commit)
+        self.commit_projects[path] = new_commits
+        self.manifest[path] = self.manifest_entry(path,previous,new_commits,getattr(project,"last_activity_at",None))
+        if self.changed_projects is not None:
+            self.changed_projects.add(path)
+
+    # SHAs are indexed as raw digests (20 bytes for sha1) rather than hex strings
+    # to keep the index small on large instances.
+    def commit_key(self,sha):
+        try:
+            return bytes.fromhex(sha)
+        except ValueError:
+            return sha
+
+    # Maps every stored commit to the project it was first seen in, streaming
+    # the shards rather than loading the history.
+    def index_commits(self):
+        for path, commit in self.iter_history():
+            key = self.commit_key(commit["id"])
+            if commit["duplicate"]:
+                self.commit_index.setdefault(key,commit.get("duplicate_of",path))
+            else:
+                self.commit_index[key] = path
+
+    # Incremental syncs only ask for commits after the recorded high-water mark.
+    # Unchanged projects (same last_activity_at) are not queried at all.
+    def commits_since(self,project):
+        entry = self.manifest.get(project.path_with_namespace)
+        if entry is None:
+            return None
+        return entry["last_commit_date"]
+
+    def is_unchanged(self,project):
+        entry = self.manifest.get(project.path_with_namespace)
+        if entry is None:
+            return False
+        last_activity = getattr(project,"last_activity_at",None)
+        return last_activity is not None and last_activity == entry["last_activity_at"]
+
+    # While a crawl runs, every finished project's shard is written straight
+    # away and the crawl state is checkpointed every CHECKPOINT_INTERVAL
+    # seconds. The checkpoint holds the manifest as of the finished projects,
+    # so an interrupted crawl picks up where it left off.
+    def checkpoint_file(self):
+        return os.path.join(self.LOCAL_HISTORY_DIR,"checkpoint.json")
 
+    def write_checkpoint(self):
+        os.makedirs(self.LOCAL_HISTORY_DIR,exist_ok=True)
+        f = open(self.checkpoint_file() + ".tmp","w")
+        f.write(json.dumps({
+            "crawl_id" : self.crawl_id,
+            "incremental" : self.changed_projects is not None,
+            "completed" : list(self.completed),
+            "removed" : list(self.removed),
+            "duplicates" : self.duplicates,
+            "manifest" : self.manifest
+        }))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(self.checkpoint_file() + ".tmp",self.checkpoint_file())
+        self.last_checkpoint = time.time()
+
+    def load_checkpoint(self):
+        try:
+            f = open(self.checkpoint_file(),"r")
+            checkpoint = json.loads(f.read())
+            f.close()
+        except (IOError,ValueError):
+            return None
+        return checkpoint
 
-    def get_latest_data(self):
+    def complete_project(self,path):
+        if path not in self.commit_projects:
+            return
+        os.makedirs(self.LOCAL_HISTORY_DIR,exist_ok=True)
+        entry = self.manifest[path]
+        entry["bytes"] = self.write_shard(entry,self.commit_projects.pop(path))
+        self.completed.add(path)
+        if time.time() - self.last_checkpoint > self.CHECKPOINT_INTERVAL:
+            self.write_checkpoint()
+
+    def summarize_crawl(self,listed,resumed):
+        self.crawl_summary = {
+            "projects" : len(listed),
+            "resumed" : resumed,
+            "fetched" : len(self.completed) - resumed,
+            "duplicates" : self.duplicates,
+            "failed" : sorted(self.failures)
+        }
+        session = getattr(self,"session",None)
+        if session is not None:
+            self.crawl_summary["http"] = session.stats()
+            self.debug("HTTP: {requests} requests at {requests_per_second:.1f}/s, {retries} retries, {wait_seconds:.1f}s waiting for the rate limit".format(**self.crawl_summary["http"]))
+        self.debug("Crawl finished: {} projects listed, {} fetched, {} resumed from checkpoint".format(len(listed),self.crawl_summary["fetched"],resumed))
+        if self.failures:
+            print("{} projects could not be fetched and are missing from this sync:".format(len(self.failures)))
+            for path in sorted(self.failures):
+                print("\t{}".format(path))
 
+    # Projects are listed with keyset pagination ordered by id, newest first
+    # like the default created_at order, falling back to offset pagination on
+    # servers that do not support keyset pagination for projects.
+    def list_projects(self):
+        listed = 0
+        try:
+            for project in self.gl.projects.list(iterator=True,pagination="keyset",order_by="id",sort="desc",per_page=self.PAGE_SIZE,obey_rate_limit=False):
+                listed += 1
+                yield project
+        except gitlab.exceptions.GitlabListError:
+            if listed:
+                raise
+            self.debug("Keyset pagination unavailable, listing projects with offset pagination")
+            for project in self.gl.projects.list(iterator=True,order_by="id",sort="desc",per_page=self.PAGE_SIZE,obey_rate_limit=False):
+                yield project
+
+    # Commits are fetched by a pool of MAX_WORKERS threads, but results are
+    # consumed in listing order (non-forked projects first, then forks) so
+    # duplicate detection behaves exactly as a serial crawl would.
+    def get_latest_data(self,incremental = False,resume = True):
+
+        import_network()
         self.connect_by_token()
 
-        self.commit_ids = []
+        self.commit_index = {}
         self.commit_projects = {}
         self.failures = []
         self.duplicates = 0
+        self.completed = set()
+        self.removed = set()
+        self.last_checkpoint = time.time()
+        projects = []
         forked_projects = []
 
-        for project in self.gl.projects.list(all=True):
-            try:
-                if project.forked_from_project:
-                    forked_projects.append(project)
+        checkpoint = self.load_checkpoint() if resume else None
+        if checkpoint:
+            self.debug("Resuming crawl from checkpoint: {} projects already done".format(len(checkpoint["completed"])))
+            self.crawl_id = checkpoint["crawl_id"]
+            incremental = checkpoint["incremental"]
+            self.manifest = checkpoint["manifest"]
+            self.completed = set(checkpoint["completed"])
+            self.removed = set(checkpoint["removed"])
+            self.duplicates = checkpoint["duplicates"]
+            self.index_commits()
+            self.changed_projects = self.completed | self.removed if incremental else None
+        elif incremental and self.manifest:
+            self.crawl_id = secrets.token_hex(4)
+            self.index_commits()
+            self.changed_projects = set()
+        else:
+            incremental = False
+            self.crawl_id = secrets.token_hex(4)
+            self.manifest = {}
+            self.changed_projects = None
+        resumed = len(self.completed)
+
+        listed = set()
+        with self.metrics.phase("api.projects"):
+            for project in self.list_projects():
+                listed.add(project.path_with_namespace)
+                if project.path_with_namespace in self.completed:
                     continue
-            except:
-                pass
-            self.debug("Querying project: {}".format(project.path_with_namespace))
-            self.query_project(project)
-        self.debug("Dataset includes {} duplicates".format(self.duplicates))
-
-        for project in forked_projects:
-            self.debug("Querying forked project: {}".format(project.path_with_namespace))
-            self.query_project(project,ignore_duplicates = True)
-        self.LOCAL_HISTORY = self.commit_projects
-    def save_latest_data(self):
-        f = open(self.LOCAL_HISTORY_FILE,"w")
-        f.write(json.dumps(self.LOCAL_HISTORY))
+                if incremental and self.is_unchanged(project):
+                    continue
+                try:
+                    if project.forked_from_project:
+                        forked_projects.append(project)
+                        continue
+                except:
+                    pass
+                projects.append(project)
+        self.metrics.count("projects_listed",len(listed))
+
+        for path in set(self.manifest.keys()) - listed:
+            self.debug("Removing deleted project: {}".format(path))
+            del self.manifest[path]
+            self.removed.add(path)
+            if self.changed_projects is not None:
+                self.changed_projects.add(path)
+        if incremental:
+            self.debug("{} of {} projects changed since last sync".format(len(projects) + len(forked_projects),len(listed)))
+
+        import concurrent.futures
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_WORKERS)
+        try:
+            for project, commits in self.fetch_in_order(pool,projects):
+                self.debug("Querying project: {}".format(project.path_with_namespace))
+                with self.metrics.phase("dedupe"):
+                    self.query_project(project,commits = commits)
+                self.complete_project(project.path_with_namespace)
+            self.debug("Dataset includes {} duplicates".format(self.duplicates))
+
+            for project, commits in self.fetch_in_order(pool,forked_projects):
+                self.debug("Querying forked project: {}".format(project.path_with_namespace))
+                with self.metrics.phase("dedupe"):
+                    self.query_project(project,ignore_duplicates = True,commits = commits)
+                self.complete_project(project.path_with_namespace)
+        except BaseException:
+            self.write_checkpoint()
+            print("Crawl interrupted after {} projects; it will resume from the checkpoint on the next refresh.".format(len(self.completed)))
+            raise
+        finally:
+            pool.shutdown(wait=False,cancel_futures=True)
+        self.summarize_crawl(listed,resumed)
+
+    # Fetches each project's commits on the pool and yields (project, commits)
+    # in listing order. At most two fetches per worker are in flight, so a
+    # slow project holds back only a bounded number of finished ones.
+    def fetch_in_order(self,pool,projects):
+        pending = collections.deque()
+        for project in projects:
+            pending.append((project,pool.submit(self.fetch_commits,project,self.commits_since(project))))
+            if len(pending) >= 2 * self.MAX_WORKERS:
+                project, future = pending.popleft()
+                yield project, future.result()
+        while pending:
+            project, future = pending.popleft()
+            yield project, future.result()
+
+    # The history is a directory of per-project JSON Lines shards plus a
+    # manifest. Each manifest entry records the shard's byte length, so an
+    # interrupted append is simply ignored, and the manifest itself is replaced
+    # atomically.
+    # Shards written by a full crawl carry its crawl_id, so they never replace
+    # files the current manifest still points at.
+    def shard_name(self,path):
+        return "{}-{}.jsonl".format(hashlib.sha1(path.encode("utf-8")).hexdigest(),self.crawl_id)
+
+    def manifest_entry(self,path,previous,new_commits,last_activity_at):
+        dates = [c["committed_date"] for c in new_commits]
+        if previous and previous["last_commit_date"]:
+            dates.append(previous["last_commit_date"])
+        return {
+            "shard" : previous["shard"] if previous else self.shard_name(path),
+            "commits" : (previous["commits"] if previous else 0) + len(new_commits),
+            "bytes" : previous["bytes"] if previous else 0,
+            "last_activity_at" : last_activity_at,
+            "last_commit_date" : max(dates, key=to_epoch, default=None)
+        }
+
+    def read_history(self,path):
+        entry = self.manifest[path]
+        remaining = entry["bytes"]
+        if remaining == 0:
+            return
+        with open(os.path.join(self.LOCAL_HISTORY_DIR,entry["shard"]),"rb") as f:
+            for line in f:
+                if remaining <= 0:
+                    break
+                remaining -= len(line)
+                yield json.loads(line)
+
+    def iter_history(self,projects = None):
+        for path in (self.manifest.keys() if projects is None else projects):
+            if path in self.manifest:
+                for commit in self.read_history(path):
+                    yield path, commit
+
+    # New shards are written to a temporary file and renamed into place;
+    # existing shards are cut back to their recorded length and appended to.
+    def write_shard(self,entry,commits):
+        with self.metrics.phase("history.write"):
+            return self.append_shard(entry,commits)
+
+    def append_shard(self,entry,commits):
+        shard = os.path.join(self.LOCAL_HISTORY_DIR,entry["shard"])
+        if entry["bytes"]:
+            f = open(shard,"r+b")
+            f.truncate(entry["bytes"])
+            f.seek(entry["bytes"])
+        else:
+            f = open(shard + ".tmp","wb")
+        for commit in commits:
+            f.write(json.dumps(commit).encode("utf-8"))
+            f.write(b"\n")
+        f.flush()
+        os.fsync(f.fileno())
+        size = f.tell()
+        f.close()
+        if not entry["bytes"]:
+            os.replace(shard + ".tmp",shard)
+        return size
+
+    def write_manifest(self):
+        manifest = os.path.join(self.LOCAL_HISTORY_DIR,"manifest.json")
+        f = open(manifest + ".tmp","w")
+        f.write(json.dumps({ "version" : 1, "projects" : self.manifest }))
+        f.flush()
+        os.fsync(f.fileno())
         f.close()
+        os.replace(manifest + ".tmp",manifest)
+
+    def save_latest_data(self):
+        os.makedirs(self.LOCAL_HISTORY_DIR,exist_ok=True)
+        for path, commits in self.commit_projects.items():
+            entry = self.manifest[path]
+            entry["bytes"] = self.write_shard(entry,commits)
+        self.write_manifest()
+        self.commit_projects = {}
+        if os.path.exists(self.checkpoint_file()):
+            os.remove(self.checkpoint_file())
+        shards = set(entry["shard"] for entry in self.manifest.values())
+        for name in os.listdir(self.LOCAL_HISTORY_DIR):
+            if name.endswith(".jsonl") and name not in shards:
+                os.remove(os.path.join(self.LOCAL_HISTORY_DIR,name))
 
     def load_data_from_file(self):
-        f = open(self.LOCAL_HISTORY_FILE,"r")
-        self.LOCAL_HISTORY = json.loads(f.read())
+        manifest = os.path.join(self.LOCAL_HISTORY_DIR,"manifest.json")
+        if not os.path.exists(manifest) and os.path.exists(self.LOCAL_HISTORY_FILE):
+            self.debug("Importing {} into {}".format(self.LOCAL_HISTORY_FILE,self.LOCAL_HISTORY_DIR))
+            self.import_history(self.LOCAL_HISTORY_FILE)
+            return
+        f = open(manifest,"r")
+        self.manifest = json.loads(f.read())["projects"]
+        f.close()
+
+    # Import/export of the single JSON blob format (project path to list of
+    # commits) used by earlier versions.
+    def import_history(self,filename):
+        f = open(filename,"r")
+        history = json.loads(f.read())
         f.close()
+        try:
+            f = open(self.LOCAL_SYNC_FILE,"r")
+            sync_state = json.loads(f.read())
+            f.close()
+        except (IOError,ValueError):
+            sync_state = {}
+        self.manifest = {}
+        self.commit_projects = {}
+        self.crawl_id = secrets.token_hex(4)
+        for path in history.keys():
+            self.commit_projects[path] = history[path]
+            self.manifest[path] = self.manifest_entry(path,None,history[path],sync_state.get(path,{}).get("last_activity_at"))
+        self.save_latest_data()
 
+    def export_history(self,filename):
+        f = open(filename,"w")
+        f.write("{")
+        for i, path in enumerate(self.manifest.keys()):
+            f.write("{}{}: [".format(", " if i else "",json.dumps(path)))
+            for j, commit in enumerate(self.read_history(path)):
+                f.write("{}{}".format(", " if j else "",json.dumps(commit)))
+            f.write("]")
+        f.write("}")
+        f.close()
+
+    # The schema version is kept in sqlite's user_version; a persistent database
+    # written by an older version is dropped and rebuilt from the history.
     def build_db(self):
-        self.db = sqlite3.connect(":memory:")
+        if self.DB_FILE == ":memory:":
+            # A named, shared-cache in-memory database so report threads can
+            # open their own connections to it.
+            self.db_uri = "file:gitlab_reports_{}?mode=memory&cache=shared".format(secrets.token_hex(8))
+            self.db = sqlite3.connect(self.db_uri,uri=True)
+        else:
+            import urllib.request
+            self.db_uri = "file:{}?mode=ro".format(urllib.request.pathname2url(os.path.abspath(self.DB_FILE)))
+            self.db = sqlite3.connect(self.DB_FILE)
         c = self.db.cursor()
-        c.execute('''CREATE TABLE committers
+        c.execute("PRAGMA user_version")
+        if c.fetchall()[0][0] != self.SCHEMA_VERSION:
+            for table in ("commits","committers","projects","meta","daily_commits"):
+                c.execute("DROP TABLE IF EXISTS {}".format(table))
+            c.execute("PRAGMA user_version = {}".format(self.SCHEMA_VERSION))
+        c.execute('''CREATE TABLE IF NOT EXISTS meta
+                     (key text PRIMARY KEY, value text)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS committers
                      (name text PRIMARY_KEY)''')
-        c.execute('''CREATE TABLE projects
+        c.execute('''CREATE TABLE IF NOT EXISTS projects
                      (project_path text PRIMARY KEY)''')
-        c.execute('''CREATE TABLE commits
-                     (committer_name text,
+        c.execute('''CREATE TABLE IF NOT EXISTS commits
+                     (id text,
+                      committer_name text,
                       committer_email text,
                       author_name text,
                       author_email text,
-                      duplicate text,
+                      duplicate integer,
+                      duplicate_of text,
                       name text,
                       project_path text,
-                      date text,
+                      date integer,
+                      UNIQUE(project_path, id),
                       FOREIGN KEY(project_path) REFERENCES projects(project_path),
                       FOREIGN KEY(name) REFERENCES committers(name)
                       )''')
+        c.execute("CREATE INDEX IF NOT EXISTS commits_by_name ON commits(duplicate, date, name)")
+        c.execute("CREATE INDEX IF NOT EXISTS commits_by_project ON commits(duplicate, date, project_path)")
+        c.execute('''CREATE TABLE IF NOT EXISTS daily_commits
+                     (day integer,
+                      name text,
+                      project_path text,
+                      duplicate integer,
+                      commits integer,
+                      PRIMARY KEY(duplicate, day, name, project_path)
+                      )''')
         self.db.commit()
 
-    def populate_db(self):
-        data = self.LOCAL_HISTORY
+    # Identifies the history file contents without reading it.
+    def history_stamp(self):
+        try:
+            st = os.stat(os.path.join(self.LOCAL_HISTORY_DIR,"manifest.json"))
+        except OSError:
+            return None
+        return "{}:{}".format(st.st_mtime_ns,st.st_size)
+
+    # sqlite connections cannot be shared between threads, so reports running on
+    # the report pool read through a connection of their own.
+    def read_cursor(self):
+        db = getattr(self.local,"db",None)
+        c = (self.db if db is None else db).cursor(row_timed_cursor if self.metrics.profile else timed_cursor)
+        c.metrics = self.metrics
+        return c
+
+    def get_meta(self,key):
+        c = self.read_cursor()
+        c.execute("SELECT value FROM meta WHERE key = ?", (key,))
+        row = c.fetchone()
+        return row[0] if row else None
+
+    def set_meta(self,key,value):
+        self.db.execute("INSERT OR REPLACE INTO meta(key,value) VALUES(?,?)", (key,value))
+
+    # A persistent database is current when it was last populated from the
+    # history file as it is on disk now, or when there is no history file at all.
+    def db_is_current(self):
+        if self.DB_FILE == ":memory:":
+            return False
+        stamp = self.get_meta("history_stamp")
+        if stamp is None:
+            return False
+        current = self.history_stamp()
+        return current is None or current == stamp
+
+    def load_db_sets(self):
         c = self.db.cursor()
-        self.users = set()
-        self.projects = set()
-        for project in data.keys():
-            c.execute("INSERT OR IGNORE INTO projects(project_path) VALUES(?)", (project,))
-            commits = data[project]
-            self.projects.add(project)
-            for commit in commits:
-                unique_name = self.unique_user_key(commit,project)
-                self.users.add(unique_name)
-                c.execute("INSERT OR IGNORE INTO committers(name) VALUES(?)", (unique_name,))
-                c.execute("INSERT INTO commits(committer_name,committer_email, author_name, author_email, project_path, date,name,duplicate) VALUES(?,?,?,?,?,?,?,?)",(commit["committer_name"], commit["committer_email"], commit["author_name"], commit["author_email"],  project,commit["committed_date"],unique_name,str(commit["duplicate"]).lower()))
+        c.execute("SELECT name FROM committers")
+        self.users = set(row[0] for row in c.fetchall())
+        c.execute("SELECT project_path FROM projects")
+        self.projects = set(row[0] for row in c.fetchall())
 
+    # Identity resolution only depends on these fields, so it is done once per
+    # distinct combination rather than once per commit.
+    def commit_rows(self,projects,identities):
+        for project in projects:
+            if project not in self.manifest:
+                continue
+            namespace = project.split("/")[0]
+            for commit in self.read_history(project):
+                identity = (commit["committer_email"], commit["author_email"], commit["committer_name"], commit["author_name"], namespace)
+                try:
+                    unique_name = identities[identity]
+                except KeyError:
+                    unique_name = identities[identity] = self.unique_user_key(commit,project)
+                yield (commit["id"],commit["committer_name"], commit["committer_email"], commit["author_name"], commit["author_email"], project,to_epoch(commit["committed_date"]),unique_name,int(commit["duplicate"]),commit.get("duplicate_of"))
+
+    # With no argument the whole history is (re)loaded. Given a list of project
+    # paths, only those projects are replaced, which is what a sync needs.
+    # Everything happens in one transaction with durability relaxed for the
+    # duration; the database can always be rebuilt from the history.
+    def populate_db(self,projects = None):
+        with self.metrics.phase("load"):
+            self.load_projects(projects)
+        self.load_db_sets()
+        self.prune_report_cache()
+
+    def load_projects(self,projects):
+        data = self.manifest
+        start = time.time()
+        c = self.db.cursor()
+        c.execute("PRAGMA synchronous")
+        synchronous = c.fetchall()[0][0]
+        c.execute("PRAGMA synchronous = OFF")
+        c.execute("PRAGMA temp_store = MEMORY")
+        c.execute("PRAGMA cache_size = -65536")
+        if projects is None:
+            c.execute("DELETE FROM commits")
+            c.execute("DELETE FROM projects")
+            c.execute("DELETE FROM committers")
+            c.execute("DELETE FROM daily_commits")
+            projects = list(data.keys())
+        else:
+            projects = list(projects)
+            c.executemany("DELETE FROM commits WHERE project_path = ?", ((project,) for project in projects))
+            c.executemany("DELETE FROM projects WHERE project_path = ?", ((project,) for project in projects))
+            c.executemany("DELETE FROM daily_commits WHERE project_path = ?", ((project,) for project in projects))
+        c.executemany("INSERT OR IGNORE INTO projects(project_path) VALUES(?)", ((project,) for project in projects if project in data))
+
+        # A commit stored twice for one project is kept as its first, non-duplicate row.
+        identities = {}
+        rows = self.commit_rows(projects,identities)
+        inserted = 0
+        while True:
+            with self.metrics.phase("load.parse"):
+                chunk = list(itertools.islice(rows,self.LOAD_CHUNK_SIZE))
+            if not chunk:
+                break
+            with self.metrics.phase("load.insert"):
+                c.executemany("INSERT OR IGNORE INTO commits(id,committer_name,committer_email, author_name, author_email, project_path, date,name,duplicate,duplicate_of) VALUES(?,?,?,?,?,?,?,?,?,?)",chunk)
+            inserted += len(chunk)
+        self.metrics.count("rows_inserted",inserted)
+        c.executemany("INSERT OR IGNORE INTO committers(name) VALUES(?)", ((name,) for name in set(identities.values())))
+        with self.metrics.phase("load.rollup"):
+            c.executemany("INSERT INTO daily_commits(day,name,project_path,duplicate,commits) SELECT date / 86400, name, project_path, duplicate, count(*) FROM commits WHERE project_path = ? GROUP BY date / 86400, name, project_path, duplicate", ((project,) for project in projects if project in data))
+        c.execute("DELETE FROM committers WHERE name NOT IN (SELECT name FROM commits)")
+        self.set_meta("history_stamp",self.history_stamp())
         self.db.commit()
+        c.execute("PRAGMA synchronous = {}".format(synchronous))
+
+        elapsed = time.time() - start
+        self.load_stats = {
+            "rows" : inserted,
+            "identities" : len(identities),
+            "seconds" : elapsed,
+            "rows_per_second" : inserted / elapsed if elapsed > 0 else 0
+        }
+        self.debug("Loaded {} commits ({} identities) in {:.2f}s, {:.0f} rows/s".format(inserted,len(identities),elapsed,self.load_stats["rows_per_second"]))
 
     def lookup_name(self,n):
         c = self.db.cursor()
@@ -162,91 +811,240 @@ class gitlab_reports:
     # This method depends on repo_data.py: internal_data
     # repo_data.py consolidates repository-specific, custom data.
     def correlate_user(self,u):
-        if u in internal_external.keys():
-            return internal_external[u]
-        else:
-            return "unknown"
+        return internal_external.get(u,"unknown")
 
-    # This method depends on repo_data.py: namespace_to_course
-    # repo_data.py consolidates repository-specific, custom data.
+    # This method depends on repo_data.py: namespace_lookup, compiled from
+    # namespace_to_course and known_namespaces. Results are memoized per path.
     def correlate_project(self,p):
+        try:
+            return self.project_cache[p]
+        except KeyError:
+            pass
         top_namespace = p.split("/")[0]
-        if top_namespace in namespace_to_course.keys():
-            return namespace_to_course[top_namespace],"schoolhouse"
-        elif top_namespace in known_namespaces:
-            return top_namespace, "operational"
-        else:
-            return top_namespace, "personal"
+        result = namespace_lookup.get(top_namespace,(top_namespace, "personal"))
+        self.project_cache[p] = result
+        return result
 
-    # This method depends on repo_data.py: known_aliases
-    # repo_data.py consolidates repository-specific, custom data.
+    # This method depends on repo_data.py: alias_to_primary, compiled from
+    # known_aliases. Results are memoized per name.
     def de_alias(self,name):
-        for k in known_aliases.keys():
-            if name.lower() in known_aliases[k]:
-                return k
-        if name[-4:] == ".mil" or name[-4:] == ".ctr" or name[-4:] == ".civ":
-            name = name[:-4]
-        return name
+        try:
+            return self.alias_cache[name]
+        except KeyError:
+            pass
+        result = alias_to_primary.get(name.lower())
+        if result is None:
+            result = name
+            if name[-4:] == ".mil" or name[-4:] == ".ctr" or name[-4:] == ".civ":
+                result = name[:-4]
+        self.alias_cache[name] = result
+        return result
+
+    # After editing repo_data.py tables at runtime.
+    def reload_lookups(self):
+        compile_lookups()
+        self.alias_cache = {}
+        self.project_cache = {}
 
     # This method depends on repo_data.py: anonymous_emails
     # repo_data.py consolidates repository-specific, custom data.
     def unique_user_key(self,commit,project):
         k = self.de_alias(commit["committer_email"])
-        if k == "" or k in anonymous_emails:
+        if k == "" or k in anonymous_lookup:
             k = self.de_alias(commit["author_email"])
-        if k == "" or k in anonymous_emails:
+        if k == "" or k in anonymous_lookup:
             k = self.de_alias(commit["committer_name"])
-        if k == "" or k in anonymous_emails:
+        if k == "" or k in anonymous_lookup:
             k = self.de_alias(commit["author_name"])
         k = self.de_alias(k.split("@")[0])
-        if k == "" or k in anonymous_emails:
+        if k == "" or k in anonymous_lookup:
             k = self.de_alias(project.split("/")[0] + "/")
             if k[-1:] == "/":
                 k = k[:-1]
         return self.de_alias(k)
 
+    # Identifies the data the reports are computed from: the history the
+    # database was loaded from and the repo_data.py classification tables.
+    def data_version(self):
+        lookups = json.dumps([anonymous_emails,known_aliases,known_namespaces,internal_external,namespace_to_course],sort_keys=True)
+        return "{}:{}".format(self.get_meta("history_stamp"),hashlib.sha1(lookups.encode("utf-8")).hexdigest())
+
+    # A cached entry holds the report's output lines and the csv and chartjs
+    # entries it produced. Anonymized reports are keyed by the salt, since
+    # their hashes are only valid within one run.
+    def cached_call(self,method,args,kwargs):
+        arguments = inspect.signature(method).bind(self,*args,**kwargs)
+        arguments.apply_defaults()
+        params = dict(arguments.arguments)
+        del params["self"]
+        version = self.data_version()
+        key = json.dumps([method.__name__,params,self.salt if self.anonymize else False,version],sort_keys=True,default=str)
+        with self.cache_lock:
+            entry = self.report_cache.get(key)
+            if entry is not None:
+                self.report_cache.move_to_end(key)
+        if entry is not None:
+            streams = self.cached_streams(entry)
+            if streams is not None:
+                self.metrics.count("report_cache_hits")
+                for line in entry["output"]:
+                    self.emit(line)
+                self.csv.update(entry["csv"])
+                self.csv.update(streams)
+                self.chartjs.update(entry["chartjs"])
+                return
+        # The report writes into dicts of its own, which are what gets cached
+        # and merged into the caller's results afterwards.
+        csv_results = self.csv
+        chartjs_results = self.chartjs
+        outer_csv = getattr(self.local,"csv",None)
+        outer_chartjs = getattr(self.local,"chartjs",None)
+        self.local.csv = {}
+        self.local.chartjs = {}
+        self.metrics.count("report_cache_misses")
+        self.local.report_log = []
+        try:
+            with self.metrics.phase("report." + method.__name__):
+                method(self,*args,**kwargs)
+            output = self.local.report_log
+            tables = self.local.csv
+            charts = self.local.chartjs
+        except BaseException:
+            for table in self.local.csv.values():
+                if isinstance(table,csv_stream):
+                    table.discard()
+            raise
+        finally:
+            self.local.report_log = None
+            self.local.csv = outer_csv
+            self.local.chartjs = outer_chartjs
+        for table in tables.values():
+            if isinstance(table,csv_stream):
+                table.close()
+                self.metrics.count("csv_rows",table.rows)
+        csv_results.update(tables)
+        chartjs_results.update(charts)
+        with self.cache_lock:
+            self.report_cache[key] = {
+                "version" : version,
+                "anonymized" : bool(self.anonymize),
+                "output" : output,
+                "csv" : dict((k,v) for k,v in tables.items() if not isinstance(v,csv_stream)),
+                "csv_files" : dict((k,v.stamp()) for k,v in tables.items() if isinstance(v,csv_stream)),
+                "chartjs" : charts
+            }
+            while len(self.report_cache) > self.REPORT_CACHE_SIZE:
+                self.report_cache.popitem(last=False)
+
+    # Streamed tables are not kept in the cache, only the files they were
+    # written to. Those files are reused while they are still the ones the
+    # cached report wrote; otherwise the report has to run again.
+    def cached_streams(self,entry):
+        streams = {}
+        for key, stamp in entry.get("csv_files",{}).items():
+            stream = csv_stream(stamp[0])
+            if stamp[0] != self.csv_path(key) or not os.path.exists(stamp[0]) or stream.stamp() != stamp:
+                return None
+            streams[key] = stream
+        return streams
+
+    # Entries computed from older data can never be hit again.
+    def prune_report_cache(self):
+        version = self.data_version()
+        for key in [k for k,v in self.report_cache.items() if v["version"] != version]:
+            del self.report_cache[key]
+
+    def load_report_cache(self):
+        self.report_cache = collections.OrderedDict()
+        if self.REPORT_CACHE_FILE is None:
+            return
+        try:
+            f = open(self.REPORT_CACHE_FILE,"r")
+            self.report_cache.update(json.loads(f.read()))
+            f.close()
+        except (IOError,ValueError):
+            pass
+
+    # Anonymized entries are keyed by this run's random salt, so no later run
+    # could hit them, and their output holds the real names next to the
+    # hashed ones in their CSV rows; they are never written out.
+    def save_report_cache(self):
+        if self.REPORT_CACHE_FILE is None:
+            return
+        f = open(self.REPORT_CACHE_FILE + ".tmp","w")
+        f.write(json.dumps([(k,v) for k,v in self.report_cache.items() if not v.get("anonymized")]))
+        f.close()
+        os.replace(self.REPORT_CACHE_FILE + ".tmp",self.REPORT_CACHE_FILE)
+
+    # The daily_commits rollup holds commit counts per (day, name, project_path,
+    # duplicate) and is rebuilt for a project whenever its commits are loaded.
+    # This returns a query producing (name, project_path, date, commits) rows
+    # for non-duplicate commits between from_date and to_date (inclusive):
+    # whole days come from the rollup, partial days at either end from the
+    # commits table, so counts are exact while cost scales with days, not commits.
+    def rollup_source(self,from_date,to_date):
+        start = to_epoch(from_date)
+        end = to_epoch(to_date)
+        first_day = -(-start // 86400)
+        last_day = (end + 1) // 86400
+        if first_day < last_day:
+            params = (first_day,last_day,start,first_day * 86400 - 1,last_day * 86400,end)
+        else:
+            params = (0,0,start,end,1,0)
+        query = '''SELECT name, project_path, day * 86400 as date, commits FROM daily_commits WHERE duplicate = 0 and day >= ? AND day < ?
+                   UNION ALL SELECT name, project_path, date, 1 FROM commits WHERE duplicate = 0 and date BETWEEN ? AND ?
+                   UNION ALL SELECT name, project_path, date, 1 FROM commits WHERE duplicate = 0 and date BETWEEN ? AND ?'''
+        return query, params
+
+    @cached_report
     def query_all_range(self,from_date,to_date):
-        c = self.db.cursor()
-        c.execute("SELECT count(*) FROM commits WHERE duplicate = 'false' and date BETWEEN datetime(?) AND datetime(?)", (from_date,to_date))
+        c = self.read_cursor()
+        c.execute("SELECT count(*) FROM commits WHERE duplicate = 0 and date BETWEEN ? AND ?", (to_epoch(from_date),to_epoch(to_date)))
         total_commits = c.fetchall()[0][0]
-        print("Total Commits: {}".format(total_commits))
-        print("===================\n")
-        self.csv["total_commits"] = [("total_commits",)]
+        self.out("Total Commits: {}".format(total_commits))
+        self.out("===================\n")
+        self.csv["total_commits"] = self.csv_table("total_commits",("total_commits",))
         self.csv["total_commits"].append((total_commits,))
         self.chartjs["total_commits"] = total_commits;
 
+    @cached_report
     def query_by_user(self,from_date,to_date):
-        print("Commits by user:")
-        print("================")
-        c = self.db.cursor()
-        c.execute("SELECT name, count(*) as 'commits' FROM commits WHERE duplicate = 'false' and date BETWEEN datetime(?) AND datetime(?) group by commits.name order by commits desc", (from_date,to_date))
-        self.csv["by_user"] = [("name","commit_count","user_type")]
-        for row in c.fetchall():
+        self.out("Commits by user:")
+        self.out("================")
+        c = self.read_cursor()
+        source, params = self.rollup_source(from_date,to_date)
+        c.execute("SELECT name, sum(commits) as 'commits' FROM (" + source + ") group by name order by commits desc", params)
+        self.csv["by_user"] = self.csv_table("by_user",("name","commit_count","user_type"))
+        for row in c:
             user = self.correlate_user(row[0])
-            print("{:<30}{:<12}{}".format(row[0],row[1],user))
+            self.out("{:<30}{:<12}{}".format(row[0],row[1],user))
             self.csv["by_user"].append((self.anonymize_value(row[0]),row[1],user))
 
+    @cached_report
     def query_by_project(self,from_date,to_date):
-        print("Commits by project:")
-        print("================")
-        c = self.db.cursor()
-        c.execute("SELECT project_path, count(*) as 'commits' FROM commits WHERE duplicate = 'false' and date BETWEEN datetime(?) AND datetime(?) group by commits.project_path order by project_path asc", (from_date,to_date))
-        self.csv["by_project"] = [("project_path", "commit_count","project_group","project_type")]
-        for row in c.fetchall():
+        self.out("Commits by project:")
+        self.out("================")
+        c = self.read_cursor()
+        source, params = self.rollup_source(from_date,to_date)
+        c.execute("SELECT project_path, sum(commits) as 'commits' FROM (" + source + ") group by project_path order by project_path asc", params)
+        self.csv["by_project"] = self.csv_table("by_project",("project_path", "commit_count","project_group","project_type"))
+        for row in c:
             project_group, project_type = self.correlate_project(row[0])
             if project_type == "personal":
                 project_group = self.anonymize_value(project_group)
-            print("{:<75}{:<12}{:<30}{}".format(row[0],row[1],project_group,project_type))
+            self.out("{:<75}{:<12}{:<30}{}".format(row[0],row[1],project_group,project_type))
             self.csv["by_project"].append((self.anonymize_value(row[0]),row[1],project_group,project_type))
 
+    @cached_report
     def query_by_project_by_user(self,from_date,to_date):
-        print("\nCommits by project by user:")
-        print("================")
-        c = self.db.cursor()
-        c.execute("SELECT project_path, name, count(*) as 'commits' FROM commits WHERE duplicate = 'false' and date BETWEEN datetime(?) AND datetime(?) group by commits.name, commits.project_path order by project_path asc, commits desc", (from_date,to_date))
+        self.out("\nCommits by project by user:")
+        self.out("================")
+        c = self.read_cursor()
+        source, params = self.rollup_source(from_date,to_date)
+        c.execute("SELECT project_path, name, sum(commits) as 'commits' FROM (" + source + ") group by name, project_path order by project_path asc, commits desc", params)
         path = set()
-        self.csv["by_user_and_project"] = [("name","user_type","project","commit_count","project_group","project_type")]
-        for row in c.fetchall():
+        self.csv["by_user_and_project"] = self.csv_table("by_user_and_project",("name","user_type","project","commit_count","project_group","project_type"))
+        for row in c:
             project_group, project_type = self.correlate_project(row[0])
             if project_type == "personal":
                 project_group = self.anonymize_value(project_group)
@@ -255,19 +1053,44 @@ class gitlab_reports:
 
             if row[0] not in path:
                 path.add(row[0])
-                print("\n" + row[0] + " - " + project_group + " - " + project_type)
-            print("\t{:<30}{:<12}{}".format(row[1], row[2],user_type))
+                self.out("\n" + row[0] + " - " + project_group + " - " + project_type)
+            self.out("\t{:<30}{:<12}{}".format(row[1], row[2],user_type))
             self.csv["by_user_and_project"].append((user_name,user_type,self.anonymize_value(row[0]),row[2],project_group, project_type))
 
+    # Sums counts into a dense (row x column) matrix of lists. Rows are given
+    # as codes 0..nrows-1, columns as raw values; returns the sorted distinct
+    # column values (the chart labels) and the matrix. With the numpy engine
+    # the columns are coded with numpy.unique and summed with bincount.
+    def count_matrix(self,row_codes,nrows,columns,counts = None,reverse = False):
+        if self.ENGINE == "numpy":
+            labels, column_codes = numpy.unique(numpy.asarray(columns),return_inverse=True)
+            if reverse:
+                labels = labels[::-1]
+                column_codes = len(labels) - 1 - column_codes
+            weights = None if counts is None else numpy.asarray(counts,dtype=numpy.float64)
+            codes = numpy.asarray(row_codes,dtype=numpy.int64) * len(labels) + column_codes
+            matrix = numpy.bincount(codes,weights=weights,minlength=nrows * len(labels))
+            return labels.tolist(), matrix.astype(numpy.int64).reshape(nrows,len(labels)).tolist()
+        labels = sorted(set(columns),reverse=reverse)
+        index = dict((label,i) for i,label in enumerate(labels))
+        matrix = [[0] * len(labels) for i in range(nrows)]
+        for row, column, count in zip(row_codes,columns,itertools.repeat(1) if counts is None else counts):
+            matrix[row][index[column]] += count
+        return labels, matrix
+
+    @cached_report
     def query_by_user_by_project(self,from_date,to_date):
-        print("\nCommits by user by project")
-        print("================")
-        chartjs_labels = set()
+        self.out("\nCommits by user by project")
+        self.out("================")
         chartjs_user_datasets = {}
-        c = self.db.cursor()
-        c.execute("SELECT project_path, name, count(*) as 'commits_count' FROM commits WHERE duplicate = 'false' and date BETWEEN datetime(?) AND datetime(?) group by commits.name, commits.project_path order by name asc, project_path asc", (from_date,to_date))
+        user_codes = []
+        project_labels = []
+        counts = []
+        c = self.read_cursor()
+        source, params = self.rollup_source(from_date,to_date)
+        c.execute("SELECT project_path, name, sum(commits) as 'commits_count' FROM (" + source + ") group by name, project_path order by name asc, project_path asc", params)
         user_set = set()
-        for row in c.fetchall():
+        for row in c:
             project_group, project_type = self.correlate_project(row[0])
             user_name = self.anonymize_value(row[1])
 
@@ -276,36 +1099,28 @@ class gitlab_reports:
                 project_label = project_type
             else:
                 project_label = project_group
-            chartjs_labels.add(project_label)
-            try:
-                chartjs_user_datasets[user_name]["data"][project_label] = row[2]
-            except:
+            if user_name not in chartjs_user_datasets:
                 chartjs_user_datasets[user_name] = {
-                    "data" : {
-                        project_label : row[2]
-                    },
+                    "data" : len(chartjs_user_datasets),
                     "stack" : "0",
                     "label": user_name,
                     "backgroundColor" : "#"+self.hash_value(user_name)[-6:]
                 }
+            user_codes.append(chartjs_user_datasets[user_name]["data"])
+            project_labels.append(project_label)
+            counts.append(row[2])
 
             user_type = self.correlate_user(row[1])
             if row[1] not in user_set:
                 user_set.add(row[1])
-                print("\n" + row[1] + " - " + user_type)
-            print("\t{:<75}{:<12}{:<30}{}".format(row[0], row[2],project_group, project_type))
+                self.out("\n" + row[1] + " - " + user_type)
+            self.out("\t{:<75}{:<12}{:<30}{}".format(row[0], row[2],project_group, project_type))
 
-        chartjs_labels = list(chartjs_labels)
+        chartjs_labels, matrix = self.count_matrix(user_codes,len(chartjs_user_datasets),project_labels,counts)
         chartjs_datasets = []
-        for user_name in chartjs_user_datasets.keys():
-            new_data = []
-            for project in chartjs_labels:
-                try:
-                    new_data.append(chartjs_user_datasets[user_name]["data"][project])
-                except:
-                    new_data.append(0)
-            chartjs_user_datasets[user_name]["data"] = new_data
-            chartjs_datasets.append(chartjs_user_datasets[user_name])
+        for dataset in chartjs_user_datasets.values():
+            dataset["data"] = matrix[dataset["data"]]
+            chartjs_datasets.append(dataset)
         self.chartjs["by_user_by_project"] =  {
             "labels" : chartjs_labels,
             "datasets" : chartjs_datasets
@@ -313,8 +1128,24 @@ class gitlab_reports:
 
 
 
+    # interval is a number of days, "day", "week" or "month". Returns the start
+    # of every window from start_time until end_time plus the end of the last.
+    def interval_windows(self,start_time,end_time,interval):
+        windows = [start_time]
+        while windows[-1] < end_time:
+            current = windows[-1]
+            if interval == "month":
+                windows.append(datetime.datetime(current.year + current.month // 12, current.month % 12 + 1, 1))
+            else:
+                windows.append(current + datetime.timedelta(days=self.INTERVAL_DAYS.get(interval,interval)))
+        return windows
+
+    # Every commit in the range is assigned to its window by the query itself
+    # (integer division of its offset from from_date, or calendar month), so
+    # the whole report is one GROUP BY streamed in window order.
+    @cached_report
     def query_by_user_by_project_over_time(self,from_date,to_date,interval=7):
-        c = self.db.cursor()
+        c = self.read_cursor()
         self.chartjs["internal_external"] =  {
             "labels" : [],
             "datasets" : [],
@@ -334,92 +1165,135 @@ class gitlab_reports:
             "data" : []
         }
 
-        self.csv["by_user_and_project_over_time"] = [("name","user_type","project","project_group","project_type","commit_count","interval ({} days)".format(interval))]
+        if interval == "month":
+            interval_label = "interval (month)"
+        else:
+            interval_label = "interval ({} days)".format(self.INTERVAL_DAYS.get(interval,interval))
+        self.csv["by_user_and_project_over_time"] = self.csv_table("by_user_and_project_over_time",("name","user_type","project","project_group","project_type","commit_count",interval_label))
         start_time = datetime.datetime.strptime(from_date,"%Y-%m-%dT%H:%M:%S.%fZ")
         end_time = datetime.datetime.strptime(to_date,"%Y-%m-%dT%H:%M:%S.%fZ")
-        hop = datetime.timedelta(days=interval)
-        print("\nCommits by user by project over time")
-        print("================")
-        while start_time < end_time:
-            next_time = start_time+hop
+        windows = self.interval_windows(start_time,end_time,interval)
+        start = to_epoch(windows[0])
+        if interval == "month":
+            bucket = "(CAST(strftime('%Y',date,'unixepoch') AS integer) * 12 + CAST(strftime('%m',date,'unixepoch') AS integer)) - {}".format(start_time.year * 12 + start_time.month)
+        else:
+            bucket = "(date - {}) / {}".format(start,self.INTERVAL_DAYS.get(interval,interval) * 86400)
+        # The rollup's whole days only line up with the windows when they start at midnight.
+        if start % 86400 == 0:
+            source, params = self.rollup_source(windows[0],to_epoch(windows[-1]) - 1)
+        else:
+            source, params = "SELECT name, project_path, date, 1 as commits FROM commits WHERE duplicate = 0 and date >= ? AND date < ?", (start,to_epoch(windows[-1]))
+        c.execute("SELECT " + bucket + " as bucket, project_path, name, sum(commits) as 'commits' FROM (" + source + ") group by bucket, name, project_path order by bucket asc, name asc, project_path asc", params)
+        groups = itertools.groupby(c, key=lambda row: row[0])
+        group, rows = next(groups, (None, None))
+
+        self.out("\nCommits by user by project over time")
+        self.out("================")
+        for i in range(len(windows) - 1):
+            start_time = windows[i]
+            next_time = windows[i+1]
             self.chartjs["internal_external"]["labels"].append(str(start_time)[:10])
-            c.execute("SELECT project_path, name, count(*) as 'commits' FROM commits WHERE duplicate = 'false' and date BETWEEN datetime(?) AND datetime(?) group by commits.name, commits.project_path order by name asc, project_path asc", (str(start_time),str(next_time)))
-            print("From {} to {}".format(str(start_time),str(next_time)))
+            self.out("From {} to {}".format(str(start_time),str(next_time)))
             user_set = set()
             ext_count = 0
             int_count = 0
-            for row in c.fetchall():
-                project_group, project_type = self.correlate_project(row[0])
-                user_type = self.correlate_user(row[1])
-                if project_type == "personal":
-                    project_group = self.anonymize_value(project_group)
-                if row[1] not in user_set:
-                    user_set.add(row[1])
-                    print("\n" + row[1] + " - " + user_type)
-                print("\t{:<75}{:<12}{:<30}{}".format(row[0], row[2],project_group,project_type))
-                self.csv["by_user_and_project_over_time"].append((self.anonymize_value(row[1]),user_type,self.anonymize_value(row[0]),project_group,project_type,row[2],str(start_time)))
-                if user_type == "internal":
-                    int_count += int(row[2])
-                else:
-                    ext_count += int(row[2])
+            if group == i:
+                for row in rows:
+                    row = row[1:]
+                    project_group, project_type = self.correlate_project(row[0])
+                    user_type = self.correlate_user(row[1])
+                    if project_type == "personal":
+                        project_group = self.anonymize_value(project_group)
+                    if row[1] not in user_set:
+                        user_set.add(row[1])
+                        self.out("\n" + row[1] + " - " + user_type)
+                    self.out("\t{:<75}{:<12}{:<30}{}".format(row[0], row[2],project_group,project_type))
+                    self.csv["by_user_and_project_over_time"].append((self.anonymize_value(row[1]),user_type,self.anonymize_value(row[0]),project_group,project_type,row[2],str(start_time)))
+                    if user_type == "internal":
+                        int_count += int(row[2])
+                    else:
+                        ext_count += int(row[2])
+                group, rows = next(groups, (None, None))
             chartjs_external["data"].append(ext_count)
             chartjs_internal["data"].append(int_count)
 
-
-            start_time = next_time
-            print("")
+            self.out()
         self.chartjs["internal_external"]["datasets"].append(chartjs_external)
         self.chartjs["internal_external"]["datasets"].append(chartjs_internal)
 
 
+    # The CSV rows are streamed straight from the cursor; the chart is built
+    # from a per-user, per-day aggregate, so memory scales with users x days
+    # rather than with commits.
+    @cached_report
     def query_all_commits(self,from_date,to_date):
-        self.chartjs["all_commits"] =  {
-            "labels" : set(),
-            "datasets" : {},
-        }
-        self.csv["all_commits"] = [("name", "user_type", "project", "project_group", "project_type","date" )]
-        c = self.db.cursor()
-        c.execute("SELECT name, project_path, date FROM commits WHERE duplicate = 'false' and date BETWEEN datetime(?) AND datetime(?) order by name asc", (from_date,to_date))
-        for row in c.fetchall():
+        self.csv["all_commits"] = self.csv_table("all_commits",("name", "user_type", "project", "project_group", "project_type","date" ))
+        c = self.read_cursor()
+        c.execute("SELECT name, project_path, datetime(date,'unixepoch') FROM commits WHERE duplicate = 0 and date BETWEEN ? AND ? order by name asc", (to_epoch(from_date),to_epoch(to_date)))
+        for row in c:
             project_group, project_type = self.correlate_project(row[1])
             user_type = self.correlate_user(row[0])
+            if project_type == "personal":
+                project_group = self.anonymize_value(project_group)
+            self.csv["all_commits"].append((self.anonymize_value(row[0]),user_type,self.anonymize_value(row[1]),project_group,project_type,row[2]))
+
+        chartjs_user_datasets = {}
+        user_codes = []
+        days = []
+        counts = []
+        source, params = self.rollup_source(from_date,to_date)
+        c.execute("SELECT name, date(date,'unixepoch') as day, sum(commits) FROM (" + source + ") group by name, day order by name asc", params)
+        for row in c:
             user_name = self.anonymize_value(row[0])
-            commit_date = row[2][:10]
-            self.chartjs["all_commits"]["labels"].add(commit_date)
-            try:
-                self.chartjs["all_commits"]["datasets"][user_name]["data"][commit_date] += 1
-            except:
+            if user_name not in chartjs_user_datasets:
                 color = "#"+self.hash_value(user_name)[-6:]
-                self.chartjs["all_commits"]["datasets"][user_name] = {
-                    "data" : {
-                        commit_date : 1
-                    },
+                chartjs_user_datasets[user_name] = {
+                    "data" : len(chartjs_user_datasets),
                     "fill" : False,
                     "label": user_name,
                     "backgroundColor" : color,
                     "borderColor" : color
                 }
+            user_codes.append(chartjs_user_datasets[user_name]["data"])
+            days.append(row[1])
+            counts.append(row[2])
 
-            if project_type == "personal":
-                project_group = self.anonymize_value(project_group)
-            self.csv["all_commits"].append((user_name,user_type,self.anonymize_value(row[1]),project_group,project_type,row[2]))
-
+        labels, matrix = self.count_matrix(user_codes,len(chartjs_user_datasets),days,counts,reverse=True)
         new_datasets = []
-        self.chartjs["all_commits"]["labels"] = sorted(list(self.chartjs["all_commits"]["labels"]), reverse=True)
-        for user_name in self.chartjs["all_commits"]["datasets"].keys():
-            new_data = []
-            for day in self.chartjs["all_commits"]["labels"]:
-                try:
-                    new_data.append(self.chartjs["all_commits"]["datasets"][user_name]["data"][day])
-                except:
-                    new_data.append(0)
-            new_dataset = self.chartjs["all_commits"]["datasets"][user_name]
-            new_dataset["data"] = new_data
-            new_datasets.append(new_dataset)
-        self.chartjs["all_commits"]["datasets"] = new_datasets
+        for dataset in chartjs_user_datasets.values():
+            dataset["data"] = matrix[dataset["data"]]
+            new_datasets.append(dataset)
+        self.chartjs["all_commits"] =  {
+            "labels" : labels,
+            "datasets" : new_datasets,
+        }
+
+    # Duplicates remember the project their commit was first seen in; history
+    # imported from the old single-file format does not, so those are listed
+    # with an empty duplicate_of.
+    @cached_report
+    def query_duplicates(self,from_date,to_date):
+        self.out("\nDuplicate commits by project:")
+        self.out("================")
+        c = self.read_cursor()
+        c.execute("SELECT project_path, duplicate_of, count(*) as 'commits' FROM commits WHERE duplicate = 1 and date BETWEEN ? AND ? group by project_path, duplicate_of order by project_path asc, commits desc", (to_epoch(from_date),to_epoch(to_date)))
+        self.csv["duplicates"] = self.csv_table("duplicates",("project","duplicate_of","commit_count"))
+        for row in c:
+            source = row[1] or ""
+            self.out("{:<75}{:<12}{}".format(row[0],row[2],source))
+            self.csv["duplicates"].append((self.anonymize_value(row[0]),self.anonymize_value(source) if source else "",row[2]))
 
+    # Memoized on the salted value, so every distinct name or path is hashed
+    # once per salt.
     def hash_value(self,v):
-        return hashlib.sha256(bytes(v+self.salt,"utf-8")).hexdigest()[-16:]
+        v = v+self.salt
+        try:
+            return self.hash_cache[v]
+        except KeyError:
+            pass
+        result = hashlib.sha256(bytes(v,"utf-8")).hexdigest()[-16:]
+        self.hash_cache[v] = result
+        return result
 
     def anonymize_value(self,v):
         if self.anonymize:
@@ -427,8 +1301,10 @@ class gitlab_reports:
         else:
             return v
 
+    # Streamed tables are read back from their files, so their values are
+    # all strings.
     def dump_reports_as_json(self):
-        return json.dumps(self.csv)
+        return json.dumps(dict((k,v.read() if isinstance(v,csv_stream) else v) for k,v in self.csv.items()))
 
     def generate_internal_external_dict(self):
         local_internal_external = {}
@@ -445,56 +1321,252 @@ class gitlab_reports:
         internal_external.update(local_internal_external)
         print(json.dumps(internal_external))
 
-    def build_all_reports(self,from_date,to_date):
-        self.query_all_range(from_date,to_date)
-        self.query_by_project(from_date,to_date)
-        self.query_by_user(from_date,to_date)
-        self.query_by_project_by_user(from_date,to_date)
-        self.query_by_user_by_project(from_date,to_date)
-        self.query_by_user_by_project_over_time(from_date,to_date)
-        self.query_all_commits(from_date,to_date)
+    # Runs on the report pool with its own read connection and result dicts.
+    def run_report(self,name,from_date,to_date):
+        self.local.db = sqlite3.connect(self.db_uri,uri=True)
+        self.local.csv = {}
+        self.local.chartjs = {}
+        self.local.output = []
+        try:
+            getattr(self,name)(from_date,to_date)
+            return self.local.csv, self.local.chartjs, self.local.output
+        finally:
+            self.local.db.close()
+            self.local.db = None
+            self.local.csv = None
+            self.local.chartjs = None
+            self.local.output = None
+
+    # With parallel=True every report runs on its own thread; results and
+    # output are merged in the same order as a sequential run.
+    def build_all_reports(self,from_date,to_date,parallel=False):
+        self.metrics.start()
+        with self.metrics.phase("reports"):
+            self.run_reports(from_date,to_date,parallel)
         self.chartjs["date_range"] = "{} to {}".format(from_date,to_date)
         self.write_charts()
         self.write_csv()
+        self.save_report_cache()
+        self.finish_metrics("build_all_reports",from_date=from_date,to_date=to_date,parallel=parallel)
+
+    def run_reports(self,from_date,to_date,parallel):
+        if parallel:
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.MAX_WORKERS,len(self.REPORTS))) as pool:
+                results = list(pool.map(lambda name: self.run_report(name,from_date,to_date), self.REPORTS))
+            for csv, chartjs, output in results:
+                self.csv.update(csv)
+                self.chartjs.update(chartjs)
+                for line in output:
+                    print(line)
+        else:
+            for name in self.REPORTS:
+                getattr(self,name)(from_date,to_date)
+
+    # The run's metrics are kept in last_metrics and, with metrics_file set,
+    # appended to it as one JSON line per run.
+    def finish_metrics(self,run,**extra):
+        self.last_metrics = self.metrics.report(run,**extra)
+        self.debug("{} took {:.2f}s: {}".format(run,self.last_metrics["seconds"],", ".join("{} {:.2f}s".format(k,v["seconds"]) for k,v in self.last_metrics["phases"].items())))
+        if self.METRICS_FILE is None:
+            return
+        f = open(self.METRICS_FILE,"a")
+        f.write(json.dumps(self.last_metrics,default=str))
+        f.write("\n")
+        f.close()
+
+    # CSV_STREAM writes each report table while the report runs instead of
+    # collecting it for write_csv; CSV_COMPRESS gzips the files.
+    def csv_path(self,key):
+        return key + (".csv.gz" if self.CSV_COMPRESS else ".csv")
+
+    def csv_table(self,key,header):
+        if self.CSV_STREAM:
+            return csv_stream(self.csv_path(key),header)
+        return [header]
 
     def write_csv(self):
-        for key in self.csv.keys():
-            f = open(key+".csv", "w")
-            for row in self.csv[key]:
-                f.write(",".join(str(v) for v in row))
-                f.write("\n")
+        with self.metrics.phase("write.csv"):
+            self.write_csv_tables()
+
+    def write_csv_tables(self):
+        for key, table in self.csv.items():
+            if isinstance(table,csv_stream):
+                continue # written while the report ran
+            f = csv_stream(self.csv_path(key),table[0])
+            for row in table[1:]:
+                f.append(row)
             f.close()
+            self.metrics.count("csv_rows",f.rows)
+    # Turns a dense day series into sparse {x,y} points, dropping the zero
+    # days. Series longer than CHART_MAX_POINTS days are summed into weeks
+    # (keyed by the week's monday) first.
+    def sparse_series(self,chart):
+        labels = chart["labels"]
+        bucket = "day"
+        if len(labels) > self.CHART_MAX_POINTS:
+            bucket = "week"
+            days = [datetime.date.fromisoformat(label) for label in labels]
+            labels = [str(day - datetime.timedelta(days=day.weekday())) for day in days]
+        def points(dataset):
+            sums = {}
+            for x, y in zip(labels,dataset["data"]):
+                if y:
+                    sums[x] = sums.get(x,0) + y
+            sparse = dict(dataset)
+            sparse["data"] = [{"x" : x, "y" : y} for x, y in sorted(sums.items())]
+            return sparse
+        return bucket, (points(dataset) for dataset in chart["datasets"])
+
+    # Writes one chart variable a dataset at a time, so the whole chart is
+    # never held as a single json string.
+    def write_chart(self,f,key):
+        chart = self.chartjs[key]
+        if not isinstance(chart,dict) or "datasets" not in chart:
+            f.write("var {} = {};\n".format(key,json.dumps(chart)))
+            return
+        if self.CHART_FORMAT == "dense":
+            separators = (", ",": ")
+        else:
+            separators = (",",":")
+        f.write("var {} = {{".format(key))
+        if self.CHART_FORMAT != "dense" and key in self.SPARSE_CHARTS:
+            bucket, datasets = self.sparse_series(chart)
+            f.write('"bucket"{}{}{}'.format(separators[1],json.dumps(bucket),separators[0]))
+        else:
+            datasets = chart["datasets"]
+            f.write('"labels"{}{}{}'.format(separators[1],json.dumps(chart["labels"],separators=separators),separators[0]))
+        f.write('"datasets"{}['.format(separators[1]))
+        for i, dataset in enumerate(datasets):
+            if i:
+                f.write(separators[0])
+            f.write(json.dumps(dataset,separators=separators))
+        f.write("]};\n")
+
+    # dense is the original format: one value per label per dataset. sparse
+    # writes the day series as {x,y} points without the zero days, and split
+    # additionally writes every chart to its own file under CHART_DIR, listed
+    # in chartjsdata.js for view_in_chartsjs.html to load.
     def write_charts(self):
+        with self.metrics.phase("write.charts"):
+            self.write_chart_files()
+
+    def write_chart_files(self):
         f = open("chartjsdata.js", "w")
+        if self.CHART_FORMAT != "dense":
+            f.write("var chart_format = {};\n".format(json.dumps(self.CHART_FORMAT)))
+        chart_files = {}
         for key in self.chartjs.keys():
-            try:
-                data_to_write = json.dumps({
-                    "labels" : self.chartjs[key]["labels"],
-                    "datasets" : self.chartjs[key]["datasets"]
-                })
-            except:
-                data_to_write = json.dumps(self.chartjs[key])
-            f.write("var {} = {};\n".format(key,data_to_write))
+            if self.CHART_FORMAT == "split" and isinstance(self.chartjs[key],dict):
+                os.makedirs(self.CHART_DIR,exist_ok=True)
+                chart_files[key] = "{}/{}.js".format(self.CHART_DIR,key)
+                with open(chart_files[key],"w") as chart_file:
+                    self.write_chart(chart_file,key)
+            else:
+                self.write_chart(f,key)
+        if self.CHART_FORMAT == "split":
+            f.write("var chart_files = {};\n".format(json.dumps(chart_files)))
         f.close()
-    def refresh_data(self, api_code=""):
+    # populate=False only updates the history, leaving the database as it is.
+    def refresh_data(self, api_code="", incremental=False, resume=True, populate=True):
         try:
             self.API_CODE
         except AttributeError:
             self.get_access_code(api_code)
+        if incremental and not self.manifest:
+            try:
+                self.load_data_from_file()
+            except:
+                self.debug("Did not find history file: {}. Doing full pull.".format(self.LOCAL_HISTORY_FILE))
+        self.metrics.start()
         self.debug("Getting the data.")
-        self.get_latest_data()
+        with self.metrics.phase("crawl"):
+            self.get_latest_data(incremental=incremental,resume=resume)
         self.debug("Got the data.")
-        self.save_latest_data()
-        self.build_db()
-        self.populate_db()
+        with self.metrics.phase("save"):
+            self.save_latest_data()
+        if populate:
+            try:
+                self.db
+            except AttributeError:
+                self.build_db()
+            self.populate_db(self.changed_projects)
+        if "http" in self.crawl_summary:
+            self.metrics.count("api_requests",self.crawl_summary["http"]["requests"])
+        self.finish_metrics("refresh_data",crawl=self.crawl_summary,load=self.load_stats if populate else None)
 
-    def __init__(self, base_url=BASE_GITLAB_URL, api_code="", fresh=False,debug=False,verbose=False,anonymize = False):
+    # Brings the history up to date: incrementally when there is history to
+    # build on, with a full crawl otherwise. An in-memory database would be
+    # thrown away with the process, so it is only updated for a db_file.
+    def sync(self,full = False,resume = True):
+        populate = self.DB_FILE != ":memory:"
+        if not full and not self.manifest:
+            try:
+                self.load_data_from_file()
+            except (IOError,ValueError):
+                pass
+        if full or not self.manifest:
+            self.refresh_data(incremental=False,resume=resume,populate=populate)
+            return
+        if populate:
+            try:
+                self.db
+            except AttributeError:
+                self.build_db()
+            if not self.db_is_current(): # an incremental load needs the rest of the history in place
+                self.populate_db()
+        self.refresh_data(incremental=True,resume=resume,populate=populate)
+
+    def __init__(self, base_url=BASE_GITLAB_URL, api_code="", fresh=False,debug=False,verbose=False,anonymize = False,workers = MAX_WORKERS,db_file = None,rate_limit = RATE_LIMIT,commit_fields = (),report_cache = None,quiet = False,engine = "python",chart_format = CHART_FORMAT,stream_csv = CSV_STREAM,compress_csv = CSV_COMPRESS,metrics_file = METRICS_FILE,profile = False,trace_memory = False,load = True):
         self.DEBUG = debug
+        self.MAX_WORKERS = workers
+        self.RATE_LIMIT = rate_limit
+        self.commit_fields = self.COMMIT_FIELDS + tuple(f for f in commit_fields if f not in self.COMMIT_FIELDS)
         self.VERBOSE = verbose
         self.BASE_URL = base_url
+        self.DB_FILE = db_file or ":memory:"
         self.salt = secrets.token_hex(32)
+        self.manifest = {}
+        self.commit_projects = {}
+        self.alias_cache = {}
+        self.project_cache = {}
+        self.hash_cache = {}
         self.anonymize = anonymize
         self.debug("Using salt {}".format(self.salt))
+        self.QUIET = quiet
+        self.METRICS_FILE = metrics_file
+        self.metrics = run_metrics(profile,trace_memory)
+        self.last_metrics = None
+        if engine == "numpy" and not import_numpy():
+            self.err("The numpy engine needs numpy installed (pip3 install numpy)")
+        self.ENGINE = engine
+        if chart_format not in self.CHART_FORMATS:
+            self.err("Unknown chart format {}, expected one of {}".format(chart_format,", ".join(self.CHART_FORMATS)))
+        self.CHART_FORMAT = chart_format
+        self.CSV_STREAM = stream_csv
+        self.CSV_COMPRESS = compress_csv
+        self.local = threading.local()
+        self.cache_lock = threading.Lock()
+        self.report_csv = {}
+        self.report_chartjs = {}
+        self.REPORT_CACHE_FILE = report_cache
+        self.load_report_cache()
+
+        if api_code != "":
+            self.get_access_code(api_code)
+        if load:
+            self.open_data(fresh)
+
+    # Opens the database, loading it from the history unless it is already
+    # current. Without any history (or with fresh) a full crawl is done first;
+    # with sync=False that is an error instead.
+    def open_data(self,fresh = False,sync = True):
+        self.build_db()
+        if not fresh and self.db_is_current(): # persistent database already matches the history
+            self.debug("Using database {}".format(self.DB_FILE))
+            self.load_db_sets()
+            return
+
         try:
             self.load_data_from_file()
             self.debug("Loaded history from file")
@@ -502,13 +1574,84 @@ class gitlab_reports:
             if not fresh:
                 self.debug("Did not find history file: {}. Doing new pull.".format(self.LOCAL_HISTORY_FILE))
 
-        if api_code != "":
-            self.get_access_code(api_code)
-        if fresh == True or self.LOCAL_HISTORY == False: # first run or explicitly directed to stay fresh
-            self.refresh_data(api_code=api_code)
+        if fresh == True or not self.manifest: # first run or explicitly directed to stay fresh
+            if not sync:
+                self.err("No local history in {}; run a sync first".format(self.LOCAL_HISTORY_DIR))
+            self.refresh_data()
         else:
-            self.build_db()
             self.populate_db()
 
+# Report range arguments may be a date or any ISO timestamp; the reports take
+# them in the same form as FROM_DATE.
+def report_date(value):
+    dt = datetime.datetime.fromisoformat(value.strip().replace("Z","+00:00"))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
 
+# Command line entry point. sync is the only command that talks to gitlab
+# (the token comes from GITLAB_API or a prompt); report and export work from
+# the local history and database only. Without a command nothing is done, so
+# python3 -i gitlab_reports.py still gives an interactive session.
+def main(argv = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        return
+    import argparse
+    report_names = [name[len("query_"):] for name in gitlab_reports.REPORTS]
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--url",default=BASE_GITLAB_URL,help="gitlab to sync from")
+    common.add_argument("--db",help="persistent sqlite database; report runs reuse it while it matches the history")
+    common.add_argument("--debug",action="store_true")
+    common.add_argument("--metrics",help="append run metrics to this JSON lines file")
+    parser = argparse.ArgumentParser(prog="gitlab_reports.py",description="Gitlab usage reports")
+    subparsers = parser.add_subparsers(dest="command",required=True)
+
+    sync = subparsers.add_parser("sync",parents=[common],help="fetch new commits from gitlab into the local history")
+    sync.add_argument("--full",action="store_true",help="crawl everything instead of only changed projects")
+    sync.add_argument("--no-resume",dest="resume",action="store_false",help="ignore the checkpoint of an interrupted crawl")
+    sync.add_argument("--workers",type=int,default=gitlab_reports.MAX_WORKERS)
+    sync.add_argument("--rate-limit",type=float,default=gitlab_reports.RATE_LIMIT)
+
+    report = subparsers.add_parser("report",parents=[common],help="run a report from local data")
+    report.add_argument("name",choices=report_names + ["all"],help="report to run; all also writes chartjsdata.js")
+    report.add_argument("--from",dest="from_date",type=report_date,default=FROM_DATE)
+    report.add_argument("--to",dest="to_date",type=report_date,default=TO_DATE)
+    report.add_argument("--quiet",action="store_true",help="only write the CSV files")
+    report.add_argument("--anonymize",action="store_true")
+    report.add_argument("--parallel",action="store_true",help="run the reports of all concurrently")
+    report.add_argument("--report-cache",help="file to keep report results in between runs")
+    report.add_argument("--engine",choices=("python","numpy"),default="python")
+    report.add_argument("--chart-format",choices=gitlab_reports.CHART_FORMATS,default=gitlab_reports.CHART_FORMAT)
+    report.add_argument("--stream-csv",action="store_true")
+    report.add_argument("--compress-csv",action="store_true")
+
+    export = subparsers.add_parser("export",parents=[common],help="write the local history as a single JSON file")
+    export.add_argument("output")
+    args = parser.parse_args(argv)
+
+    options = { "base_url" : args.url, "db_file" : args.db, "debug" : args.debug, "metrics_file" : args.metrics, "load" : False }
+    if args.command == "sync":
+        r = gitlab_reports(workers=args.workers,rate_limit=args.rate_limit,**options)
+        r.sync(full=args.full,resume=args.resume)
+    elif args.command == "report":
+        r = gitlab_reports(quiet=args.quiet,anonymize=args.anonymize,report_cache=args.report_cache,engine=args.engine,chart_format=args.chart_format,stream_csv=args.stream_csv,compress_csv=args.compress_csv,**options)
+        r.open_data(sync=False)
+        if args.name == "all":
+            r.build_all_reports(args.from_date,args.to_date,parallel=args.parallel)
+        else:
+            r.metrics.start()
+            getattr(r,"query_" + args.name)(args.from_date,args.to_date)
+            r.write_csv()
+            r.save_report_cache()
+            r.finish_metrics("report",name=args.name,from_date=args.from_date,to_date=args.to_date)
+    elif args.command == "export":
+        r = gitlab_reports(**options)
+        try:
+            r.load_data_from_file()
+        except (IOError,ValueError):
+            r.err("No local history in {}; run a sync first".format(r.LOCAL_HISTORY_DIR))
+        r.export_history(args.output)
 
+if __name__ == "__main__":
+    main()
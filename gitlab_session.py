@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import threading
+import time
+import email.utils
+import requests
+import requests.adapters
+
+# A requests session for the gitlab client that keeps the crawl under a
+# request budget. Requests are spaced out to at most requests_per_second
+# across all worker threads. The RateLimit-* headers gitlab returns are used
+# to pause before the server's limit is hit, and 429/503 responses are
+# retried after Retry-After (or an exponential backoff) while the budget is
+# halved, then grown back gradually as requests succeed.
+#
+# Connections are kept alive in a pool sized for the crawl's worker threads.
+class rate_limited_session(requests.Session):
+
+    RETRY_STATUS = (429, 503)
+
+    def __init__(self,requests_per_second=10,pool_size=8,max_retries=5,min_remaining=None):
+        super().__init__()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,pool_maxsize=pool_size)
+        self.mount("https://",adapter)
+        self.mount("http://",adapter)
+        self.max_rate = float(requests_per_second)
+        self.rate = self.max_rate
+        self.max_retries = max_retries
+        self.min_remaining = pool_size if min_remaining is None else min_remaining
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+        self.paused_until = 0
+        self.started = time.monotonic()
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+
+    def wait_for_slot(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now,self.next_slot,self.paused_until)
+            self.next_slot = slot + 1.0 / self.rate
+            self.wait_seconds += slot - now # summed over all worker threads
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self,seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until,time.monotonic() + seconds)
+
+    # Retry-After is either a number of seconds or an HTTP date.
+    def retry_after(self,response):
+        value = response.headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return max(0.0,float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0,email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError,ValueError):
+            return None
+
+    # Pause until the window resets when only a few requests are left in it.
+    def observe(self,response):
+        remaining = response.headers.get("RateLimit-Remaining")
+        reset = response.headers.get("RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining = int(remaining)
+            reset = float(reset)
+        except ValueError:
+            return
+        if remaining <= self.min_remaining:
+            self.pause(max(0.0,reset - time.time()))
+
+    def send(self,request,**kwargs):
+        attempt = 0
+        while True:
+            self.wait_for_slot()
+            response = super().send(request,**kwargs)
+            with self.lock:
+                self.requests += 1
+                if response.status_code not in self.RETRY_STATUS:
+                    self.rate = min(self.max_rate,self.rate + 0.1 * self.max_rate)
+            self.observe(response)
+            if response.status_code not in self.RETRY_STATUS or attempt == self.max_retries:
+                return response
+            delay = self.retry_after(response)
+            if delay is None:
+                delay = 2 ** attempt
+            with self.lock:
+                self.retries += 1
+                self.throttled += response.status_code == 429
+                self.rate = max(self.max_rate / 16,self.rate / 2)
+            self.pause(delay)
+            response.close()
+            attempt += 1
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        with self.lock:
+            return {
+                "requests" : self.requests,
+                "requests_per_second" : self.requests / elapsed if elapsed > 0 else 0,
+                "retries" : self.retries,
+                "throttled" : self.throttled,
+                "wait_seconds" : self.wait_seconds,
+                "current_rate" : self.rate
+            }
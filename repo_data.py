@@ -24,3 +24,27 @@ namespace_to_course["helpdesk"] = "Organization Administration"
 namespace_to_course["vta"] = "Infrastructure"
 namespace_to_course["Module1"] = "Example Course"
 namespace_to_course["Module2"] = "Example Course"
+
+
+
+# Lookup tables compiled from the data above when this file is imported, so
+# resolving an alias or namespace is a single dict lookup. If the tables above
+# are changed at runtime, call compile_lookups() again.
+alias_to_primary = {}
+namespace_lookup = {}
+anonymous_lookup = set()
+
+def compile_lookups():
+  alias_to_primary.clear()
+  for primary in known_aliases.keys():
+    for alias in known_aliases[primary]:
+      alias_to_primary.setdefault(alias, primary)
+  namespace_lookup.clear()
+  for namespace in known_namespaces:
+    namespace_lookup[namespace] = (namespace, "operational")
+  for namespace in namespace_to_course.keys():
+    namespace_lookup[namespace] = (namespace_to_course[namespace], "schoolhouse")
+  anonymous_lookup.clear()
+  anonymous_lookup.update(anonymous_emails)
+
+compile_lookups()